@@ -0,0 +1,169 @@
+import asyncio
+from collections import deque
+import logging
+import math
+import re
+import time
+
+import config
+import metrics
+
+settings = config.get_settings()
+
+logger = logging.getLogger("mundra.admission")
+
+# Endpoint classes in match order, anything else falls in "other". Sync
+# endpoints, and the bcrypt, database and export work that the async register
+# and export endpoints hand to run_in_threadpool, all share one threadpool (40
+# threads). The auth, export, qr and other limits together leave the scan
+# limit free, so scan requests always find a free thread however busy the
+# other classes are. A class missing from ADMISSION_LIMITS is not limited.
+endpoint_classes = [
+    ("scan", re.compile(r"^/(food|scan|qr/verify)$")),
+    (
+        "auth",
+        re.compile(
+            r"^/(register|login|refresh|change_pass|mumbaimun/register|events/[^/]+/register)$"
+        ),
+    ),
+    (
+        "export",
+        re.compile(
+            r"^/(backup|delegates(/import)?|(mumbaimun|events/[^/]+)/delegates(/import)?)$"
+        ),
+    ),
+    ("qr", re.compile(r"^/(qr|delegates/me/conference)$")),
+]
+
+admission_in_flight = metrics.Gauge(
+    "mundra_admission_in_flight",
+    "Requests running per endpoint class",
+    ("class",),
+)
+admission_queued = metrics.Gauge(
+    "mundra_admission_queue_depth",
+    "Requests waiting for a slot per endpoint class",
+    ("class",),
+)
+admission_shed = metrics.Counter(
+    "mundra_admission_shed_total",
+    "Requests rejected with 503 per endpoint class",
+    ("class", "reason"),
+)
+admission_wait = metrics.Histogram(
+    "mundra_admission_wait_seconds",
+    "Time requests spent queued per endpoint class",
+    ("class",),
+)
+
+
+class Gate:
+    # Concurrency limit with a bounded FIFO queue and a maximum wait
+    def __init__(self, name: str, concurrency: int, queue: int, max_wait: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiters: deque[asyncio.Future] = deque()
+
+    def _update_gauges(self):
+        admission_in_flight.set(self.active, self.name)
+        admission_queued.set(len(self.waiters), self.name)
+
+    async def acquire(self) -> str:
+        # Returns "" once admitted, otherwise why the request was shed
+        if self.active < self.concurrency and not self.waiters:
+            self.active += 1
+            self._update_gauges()
+            return ""
+        if len(self.waiters) >= self.queue:
+            return "queue_full"
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self._update_gauges()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+            return ""
+        except asyncio.TimeoutError:
+            # release() may have handed over the slot just as the wait ran out
+            if waiter.done() and not waiter.cancelled():
+                return ""
+            return "timeout"
+        except asyncio.CancelledError:
+            # Cancelled right after being granted, give the slot back
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            # A granted waiter was already removed and took over a slot
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            admission_wait.observe(time.perf_counter() - start, self.name)
+            self._update_gauges()
+
+    def release(self):
+        # Hands the slot straight to the next waiter, if any
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._update_gauges()
+                return
+        self.active -= 1
+        self._update_gauges()
+
+
+_gates: dict[str, Gate] = {}
+
+
+def _gate(path: str) -> Gate | None:
+    name = next(
+        (name for name, pattern in endpoint_classes if pattern.match(path)), "other"
+    )
+    if name not in _gates:
+        limits = settings.admission_limits.get(name)
+        if limits is None:
+            return None
+        concurrency, queue, max_wait = limits
+        _gates[name] = Gate(name, int(concurrency), int(queue), max_wait)
+    return _gates[name]
+
+
+class AdmissionMiddleware:
+    # Plain ASGI middleware that sheds load with 503 and Retry-After once an
+    # endpoint class has no free slot and its queue is full or too slow
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        gate = _gate(scope["path"]) if scope["type"] == "http" else None
+        if gate is None:
+            await self.app(scope, receive, send)
+            return
+
+        reason = await gate.acquire()
+        if reason:
+            admission_shed.inc(gate.name, reason)
+            logger.warning(
+                "Shed request", extra={"class": gate.name, "reason": reason}
+            )
+            body = b'{"detail":"Server busy, please retry"}'
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 503,
+                    "headers": [
+                        (b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode()),
+                        (b"retry-after", str(math.ceil(gate.max_wait)).encode()),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": body})
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.release()
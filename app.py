@@ -1,32 +1,68 @@
-import csv
+from datetime import timedelta
+from email.utils import formatdate, parsedate_to_datetime
 from functools import lru_cache
-from io import StringIO
+import hmac
+import logging
 import os
 from typing import Annotated
 import uuid
 
-from fastapi import APIRouter, Depends, FastAPI, Form, HTTPException, Request
-from fastapi.responses import FileResponse, JSONResponse, Response, HTMLResponse
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    FastAPI,
+    Form,
+    HTTPException,
+    Request,
+    UploadFile,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exception_handlers import http_exception_handler
+from fastapi.responses import (
+    FileResponse,
+    HTMLResponse,
+    JSONResponse,
+    ORJSONResponse,
+    PlainTextResponse,
+    Response,
+)
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from pydantic import ValidationError
 from pydantic_core import to_json
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from slowapi.util import get_remote_address
+from starlette.exceptions import HTTPException as StarletteHTTPException
 from starlette.types import Message
 
 from auth import (
     check_verification_token,
     create_access_token,
+    create_tokens,
+    get_current_principal,
     get_current_user,
     hash_password,
+    principal_for,
+    refresh_tokens,
+    revoke_tokens,
     verify_password,
 )
+import admission
+import assets
 import config
 import database
+import exports
+import idempotency
+import logs
 import mails
+import metrics
 import models
+import profiling
+import querylog
+import tracing
 import utils
 
 ####################
@@ -37,21 +73,57 @@ limiter = Limiter(key_func=get_remote_address)
 
 settings = config.get_settings()
 
+logs.setup_logging(settings.log_level)
+tracing.setup_tracing()
+logger = logging.getLogger("mundra.app")
+
 app = FastAPI(
     title="MUNDRA - MUNSoc Delegate Resource Application",
     description="Named after Mundra Port, Kutch, Gujarat, MUNDRA - MUNSoc Delegate Resource Application is a centralized database designed to optimize event planning, streamline communication, and facilitate delegate management",
     version="1.0.0",
     docs_url=settings.docs_url,
     redoc_url=settings.redoc_url,
+    default_response_class=ORJSONResponse,
 )
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount(
+    "/assets", assets.AssetFiles(directory=assets.build_folder), name="assets"
+)
 templates = Jinja2Templates(directory="templates")
+templates.env.globals["asset_url"] = assets.asset_url
+templates.env.globals["asset_integrity"] = assets.asset_integrity
+
+app.add_middleware(idempotency.IdempotencyMiddleware)
+app.add_middleware(admission.AdmissionMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(profiling.ProfilingMiddleware)
+app.add_middleware(tracing.TracingMiddleware)
+app.add_middleware(logs.RequestIdMiddleware)
 
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+
+async def log_server_error(request: Request, exc: StarletteHTTPException):
+    # Routes turn unexpected exceptions into a 500 HTTPException, log the
+    # original one with its traceback before answering
+    if exc.status_code >= 500:
+        cause = exc.__cause__ or exc.__context__
+        logger.error(
+            "%s %s failed: %s",
+            request.method,
+            request.url.path,
+            exc.detail,
+            exc_info=(type(cause), cause, cause.__traceback__) if cause else None,
+        )
+    return await http_exception_handler(request, exc)
+
+
+app.add_exception_handler(StarletteHTTPException, log_server_error)
+
 database.init()
+database.load_scan_index()
 
 
 @app.get("/", tags=["Status"])
@@ -59,31 +131,157 @@ def status():
     return {"message": "Server is up and running"}
 
 
+@app.get("/metrics", tags=["Status"], response_class=PlainTextResponse)
+def get_metrics(request: Request):
+    # Closed until METRICS_TOKEN is set, route and query labels are not public
+    if not settings.metrics_token or not hmac.compare_digest(
+        request.headers.get("authorization", ""), f"Bearer {settings.metrics_token}"
+    ):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def import_format(file: UploadFile, format: str) -> str:
+    if format:
+        return format
+    if file.filename and file.filename.lower().endswith(".csv"):
+        return "csv"
+    return "ndjson"
+
+
+def json_response(data, headers: dict[str, str] | None = None) -> Response:
+    # Returning a Response skips FastAPI's response_model re-validation and
+    # jsonable_encoder pass, models are serialized once by pydantic-core
+    return Response(
+        content=to_json(data), media_type="application/json", headers=headers
+    )
+
+
+def cache_headers(table: str, *key: str) -> dict[str, str]:
+    version, updated_at = database.get_data_version(table)
+    scope = database.table_scope(table)
+    headers = {"ETag": 'W/"' + "-".join([scope, *key, str(version)]) + '"'}
+    if updated_at is not None:
+        headers["Last-Modified"] = formatdate(updated_at, usegmt=True)
+    return headers
+
+
+def not_modified(request: Request, headers: dict[str, str]) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etag = headers["ETag"].removeprefix("W/")
+        return any(
+            tag.strip() == "*" or tag.strip().removeprefix("W/") == etag
+            for tag in if_none_match.split(",")
+        )
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and "Last-Modified" in headers:
+        try:
+            return parsedate_to_datetime(if_modified_since) >= parsedate_to_datetime(
+                headers["Last-Modified"]
+            )
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def parse_fields(fields: str, columns: tuple[str, ...]) -> list[str]:
+    # Comma separated sparse fieldset, returned in table column order so
+    # every ordering of the same fields shares one ETag and one export file
+    parsed = {f.strip() for f in fields.split(",") if f.strip()}
+    order = ("id", *columns)
+    unknown = [field for field in parsed if field not in order]
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+        )
+    return [field for field in order if field in parsed]
+
+
+def check_batch_size(batch: models.BatchRequest):
+    if len(batch.ids) + len(batch.emails) > settings.batch_lookup_limit:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {settings.batch_lookup_limit} ids and emails per batch",
+        )
+
+
+def export_response(
+    request: Request,
+    table: str,
+    format: str,
+    headers: dict[str, str],
+    load,
+    fields: list[str] | None = None,
+) -> Response:
+    format = "csv" if format == "csv" else "json"
+    media_type = "text/csv" if format == "csv" else "application/json"
+    name = database.table_scope(table)
+    if fields:
+        # Each fieldset is its own artifact, named in table column order by
+        # parse_fields. "+" keeps it out of the glob that cleans up the full
+        # export's old versions, its own are removed when it is rebuilt
+        name = f"{name}+{'.'.join(fields)}"
+
+    def version() -> str:
+        version, updated_at = database.get_data_version(table)
+        return f"{version}-{updated_at or 0}"
+
+    def content() -> bytes | None:
+        data = load()
+        if not data:
+            return None
+        if format == "csv":
+            if fields:
+                return exports.rows_to_csv(data, fields).encode()
+            return exports.to_csv(data).encode()
+        return to_json(data)
+
+    path, data = exports.get_or_build(f"{name}-{format}", version, content)
+    if path is None:
+        if data is None:
+            raise HTTPException(status_code=404, detail="No delegates found")
+        return Response(content=data, media_type=media_type, headers=headers)
+    path, encoding = exports.negotiate(path, request.headers.get("accept-encoding", ""))
+    headers = {**headers, "Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+
+def change_page(changes: list[models.Change], since: int, limit: int) -> Response:
+    return json_response(
+        models.ChangePage(
+            changes=changes,
+            next=changes[-1].seq if changes else since,
+            more=len(changes) == limit,
+        )
+    )
+
+
+def validation_message(e: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(loc) for loc in error['loc'])}: {error['msg']}"
+        for error in e.errors()
+    )
+
+
 ####################
 
 # Auth
 
 
-@app.post(
-    "/register",
-    tags=["Auth"],
-    status_code=201,
-    responses={
-        429: {"model": models.ErrorResponse},
-        409: {"model": models.ErrorResponse},
-        500: {"model": models.ErrorResponse},
-    },
-)
-@limiter.limit("10/minute")
-async def register(request: Request, user: models.User):
-    try:
-        user.password = hash_password(user.password)
+def add_registration(user: models.User) -> models.Delegate:
+    # bcrypt and the inserts, run in the threadpool
+    user.password = hash_password(user.password)
 
-        user_exists = database.get_user_by_email(user.email)
+    with database.transaction():
+        user_exists, delegate, _ = database.get_registration(user.email)
         if user_exists:
             raise HTTPException(status_code=409, detail="User already exists")
 
-        delegate = database.get_delegate_by_email(user.email)
         if not delegate:
             uid = str(uuid.uuid4()).replace("-", "")
             delegate = database.add_delegate(
@@ -95,6 +293,23 @@ async def register(request: Request, user: models.User):
                 )
             )
         database.add_user(user)
+    return delegate
+
+
+@app.post(
+    "/register",
+    tags=["Auth"],
+    status_code=201,
+    responses={
+        429: {"model": models.ErrorResponse},
+        409: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+@limiter.limit("10/minute")
+async def register(request: Request, user: models.User):
+    try:
+        delegate = await run_in_threadpool(add_registration, user)
 
         try:
             await mails.send_verification_email(delegate)
@@ -133,13 +348,36 @@ def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends()):
                 raise HTTPException(status_code=401, detail="Invalid email")
             if not verify_password(password, user.password):
                 raise HTTPException(status_code=401, detail="Invalid password")
-            access_token = create_access_token(data={"sub": user.email})
+            delegate = database.get_delegate_by_email(user.email)
+            if delegate:
+                principal = principal_for(delegate)
+            else:
+                principal = models.Principal(email=user.email, role="delegate")
         else:
             if not verify_password(password, admin.password):
                 raise HTTPException(status_code=401, detail="Invalid password")
-            access_token = create_access_token(data={"sub": admin.email})
-        return models.Token(access_token=access_token, token_type="bearer")
+            principal = principal_for(admin)
+        return create_tokens(principal)
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 
+@app.post(
+    "/refresh",
+    tags=["Auth"],
+    response_model=models.Token,
+    responses={
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+@limiter.limit("10/minute")
+def refresh(request: Request, body: models.RefreshRequest):
+    try:
+        return refresh_tokens(body.refresh_token)
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -205,7 +443,10 @@ async def forgot_password(request: Request, email: models.EmailStr):
             raise HTTPException(status_code=404, detail="User not found")
         if not delegate.verified:
             raise HTTPException(status_code=403, detail="User not verified")
-        access_token = create_access_token(data={"sub": delegate.email})
+        access_token = create_access_token(
+            data={"sub": delegate.email},
+            expires_delta=timedelta(minutes=settings.verification_token_expire_minutes),
+        )
         link = f"{settings.url}/reset?token={access_token}"
         await mails.send_password_reset_email(delegate, link)
         return JSONResponse(
@@ -237,6 +478,7 @@ def change_password(
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         database.change_user_pass(user.email, hash_password(password))
+        revoke_tokens(user.email)
         return JSONResponse(status_code=200, content={"message": "Password changed!"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -279,6 +521,25 @@ def backup_database(user: models.Delegate | models.Admin = Depends(get_current_u
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def delegates_export(request: Request, format: str, fields: str) -> Response:
+    selected = parse_fields(fields, database.delegate_columns)
+    headers = cache_headers("delegates", format or "json", *selected)
+    if not_modified(request, headers):
+        return Response(status_code=304, headers=headers)
+    if selected:
+        return export_response(
+            request,
+            "delegates",
+            format,
+            headers,
+            lambda: database.get_delegates_fields(selected),
+            selected,
+        )
+    return export_response(
+        request, "delegates", format, headers, database.get_delegates
+    )
+
+
 @app.get(
     "/delegates",
     tags=["Admin"],
@@ -289,55 +550,346 @@ def backup_database(user: models.Delegate | models.Admin = Depends(get_current_u
         500: {"model": models.ErrorResponse},
     },
 )
-async def get_delegates(token: str = "", format: str = ""):
+async def get_delegates(
+    request: Request, token: str = "", format: str = "", fields: str = ""
+):
+    # Async only to read the token from the query string, the export itself
+    # runs in the threadpool
     try:
         user = await get_current_user(token)
         if type(user) != models.Admin:
             raise HTTPException(status_code=403, detail="Forbidden")
-        data = database.get_delegates()
-        if data:
-            if format == "csv":
-                output = StringIO()
-                writer = csv.writer(output)
-                writer.writerow(
-                    [
-                        "id",
-                        "firstname",
-                        "lastname",
-                        "email",
-                        "contact",
-                        "dateofbirth",
-                        "gender",
-                        "pastmuns",
-                    ]
+        return await run_in_threadpool(delegates_export, request, format, fields)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post(
+    "/delegates/import",
+    tags=["Admin"],
+    response_model=models.ImportResult,
+    responses={
+        400: {"model": models.ErrorResponse},
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def import_delegates(
+    background_tasks: BackgroundTasks,
+    file: UploadFile,
+    format: str = "",
+    send_verification: bool = False,
+    user: models.Delegate | models.Admin = Depends(get_current_user),
+):
+    try:
+        if type(user) != models.Admin:
+            raise HTTPException(status_code=403, detail="Forbidden")
+        format = import_format(file, format)
+        if format not in ("csv", "ndjson"):
+            raise HTTPException(status_code=400, detail="Format must be csv or ndjson")
+
+        delegates = []
+        rows = {}
+        errors = []
+        for row, record, error in utils.iter_import_rows(file.file, format):
+            if error:
+                errors.append(models.ImportRowError(row=row, error=error))
+                continue
+            if not record.get("id"):
+                record["id"] = str(uuid.uuid4()).replace("-", "")
+            try:
+                delegate = models.Delegate.model_validate(record)
+            except ValidationError as e:
+                errors.append(models.ImportRowError(row=row, error=validation_message(e)))
+                continue
+            if delegate.id in rows or delegate.email in rows:
+                errors.append(
+                    models.ImportRowError(row=row, error="Duplicate delegate in file")
                 )
+                continue
+            rows[delegate.id] = rows[delegate.email] = row
+            delegates.append(delegate)
+
+        skipped = database.add_delegates(delegates)
+        for delegate in skipped:
+            errors.append(
+                models.ImportRowError(
+                    row=rows[delegate.id], error="Delegate already exists"
+                )
+            )
+        errors.sort(key=lambda e: e.row)
 
-                for delegate in data:
-                    past_muns_info = []
-                    for mun in delegate.pastmuns:
-                        past_muns_info.append(
-                            f"{mun.name} | {mun.committee} | {mun.delegation} | {mun.year} | {mun.award}"
-                        )
+        if send_verification:
+            skipped_ids = {delegate.id for delegate in skipped}
+            for delegate in delegates:
+                if not delegate.verified and delegate.id not in skipped_ids:
+                    background_tasks.add_task(mails.send_verification_email, delegate)
 
-                    writer.writerow(
-                        [
-                            delegate.id,
-                            delegate.firstname,
-                            delegate.lastname,
-                            delegate.email,
-                            delegate.contact,
-                            delegate.dateofbirth,
-                            delegate.gender,
-                            " ; ".join(past_muns_info),
-                        ]
-                    )
+        return models.ImportResult(
+            inserted=len(delegates) - len(skipped), errors=errors
+        )
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get(
+    "/search",
+    tags=["Admin"],
+    response_model=list[models.Delegate] | list[models.MMDelegate],
+    responses={
+        400: {"model": models.ErrorResponse},
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def search_delegates(
+    q: str,
+    scope: str = "delegates",
+    limit: int = 20,
+    user: models.Delegate | models.Admin = Depends(get_current_user),
+):
+    try:
+        if type(user) != models.Admin:
+            raise HTTPException(status_code=403, detail="Forbidden")
+        limit = max(1, min(limit, 100))
+        if not any(len(term) >= database.search_min_term for term in q.split()):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Search terms need at least {database.search_min_term} characters",
+            )
+        if scope == "delegates":
+            return json_response(database.search_delegates(q, limit))
+        if scope == "mumbaimun":
+            return json_response(database.search_mm_delegates(q, limit))
+        raise HTTPException(
+            status_code=400, detail="Scope must be delegates or mumbaimun"
+        )
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get(
+    "/stats",
+    tags=["Admin"],
+    response_model=models.Stats,
+    responses={
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def get_stats(
+    refresh: bool = False,
+    user: models.Delegate | models.Admin = Depends(get_current_user),
+):
+    try:
+        if type(user) != models.Admin:
+            raise HTTPException(status_code=403, detail="Forbidden")
+        if refresh:
+            database.invalidate_stats()
+        return json_response(database.get_stats(settings.stats_refresh_seconds))
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get(
+    "/queries",
+    tags=["Admin"],
+    response_model=list[models.QueryStats],
+    responses={
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def get_query_stats(
+    limit: int = 20,
+    user: models.Delegate | models.Admin = Depends(get_current_user),
+):
+    try:
+        if type(user) != models.Admin:
+            raise HTTPException(status_code=403, detail="Forbidden")
+        return json_response(querylog.top(max(1, min(limit, 200))))
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get(
+    "/profiles",
+    tags=["Admin"],
+    response_model=list[models.Profile],
+    responses={
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def get_profiles(
+    user: models.Principal = Depends(get_current_principal),
+):
+    try:
+        if user.role != "admin":
+            raise HTTPException(status_code=403, detail="Forbidden")
+        return json_response(profiling.list_profiles())
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get(
+    "/profiles/{id}",
+    tags=["Admin"],
+    response_model=models.Profile,
+    responses={
+        403: {"model": models.ErrorResponse},
+        404: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def get_profile(
+    id: str,
+    user: models.Principal = Depends(get_current_principal),
+):
+    try:
+        if user.role != "admin":
+            raise HTTPException(status_code=403, detail="Forbidden")
+        profile = profiling.get_profile(id)
+        if not profile:
+            raise HTTPException(status_code=404, detail="Profile not found")
+        return json_response(profile)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-                csv_data = output.getvalue()
-                output.close()
 
-                return Response(content=csv_data, media_type="text/csv")
-            return data
-        raise HTTPException(status_code=404, detail="No delegates found")
+@app.get(
+    "/profiles/{id}/folded",
+    tags=["Admin"],
+    response_class=FileResponse,
+    responses={
+        403: {"model": models.ErrorResponse},
+        404: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def download_profile(
+    id: str,
+    user: models.Principal = Depends(get_current_principal),
+):
+    # Collapsed stacks, e.g. flamegraph.pl profile.folded > profile.svg
+    try:
+        if user.role != "admin":
+            raise HTTPException(status_code=403, detail="Forbidden")
+        path = profiling.folded_path(id)
+        if not path:
+            raise HTTPException(status_code=404, detail="Profile not found")
+        return FileResponse(path, media_type="text/plain", filename=f"{id}.folded")
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get(
+    "/traces/{id}",
+    tags=["Admin"],
+    response_class=HTMLResponse,
+    responses={
+        403: {"model": models.ErrorResponse},
+        404: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+async def get_trace(request: Request, id: str, token: str = "", format: str = ""):
+    # Waterfall of one sampled request, the id is its X-Trace-Id. Takes the
+    # token as a query parameter so it opens in a browser
+    try:
+        user = await get_current_principal(token)
+        if user.role != "admin":
+            raise HTTPException(status_code=403, detail="Forbidden")
+        trace = await run_in_threadpool(tracing.find_trace, id)
+        if not trace:
+            raise HTTPException(status_code=404, detail="Trace not found")
+        if format == "json":
+            return json_response(trace)
+        return templates.TemplateResponse(
+            "trace.html",
+            {"request": request, "trace": trace, "spans": tracing.waterfall(trace)},
+        )
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get(
+    "/changes",
+    tags=["Admin"],
+    response_model=models.ChangePage,
+    responses={
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def get_changes(
+    since: int = 0,
+    limit: int = 500,
+    user: models.Principal = Depends(get_current_principal),
+):
+    # Pass the returned next as since to continue, until more is false
+    try:
+        if user.role != "admin":
+            raise HTTPException(status_code=403, detail="Forbidden")
+        limit = max(1, min(limit, 1000))
+        return change_page(database.get_changes(since, limit), since, limit)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/events", tags=["Events"], response_model=list[models.Event])
+def get_events():
+    try:
+        return json_response(database.get_events())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post(
+    "/events",
+    tags=["Events"],
+    status_code=201,
+    response_model=models.Event,
+    responses={
+        403: {"model": models.ErrorResponse},
+        409: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def add_event(
+    event: models.Event,
+    user: models.Principal = Depends(get_current_principal),
+):
+    # Registers a conference and creates its shard, its routes are then
+    # served under /events/{slug}
+    try:
+        if user.role != "admin":
+            raise HTTPException(status_code=403, detail="Forbidden")
+        if database.get_event(event.slug):
+            raise HTTPException(status_code=409, detail="Event already exists")
+        return database.add_event(event)
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -354,12 +906,66 @@ async def get_delegates(token: str = "", format: str = ""):
     responses={500: {"model": models.ErrorResponse}},
 )
 def get_current_delegate(
-    user: models.Delegate | models.Admin = Depends(get_current_user),
+    request: Request,
+    user: models.Principal = Depends(get_current_principal),
 ):
     try:
-        if type(user) == models.Admin:
+        if user.role == "admin":
             raise HTTPException(status_code=500, detail="You are an admin")
-        return user
+        headers = cache_headers("delegates", user.id)
+        headers["Vary"] = "Authorization"
+        if not_modified(request, headers):
+            return Response(status_code=304, headers=headers)
+        data = database.get_delegate_by_id(user.id)
+        if data:
+            return json_response(data, headers)
+        raise HTTPException(status_code=404, detail="Delegate not found")
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get(
+    "/delegates/me/conference",
+    tags=["Delegates"],
+    response_model=models.Conference,
+    responses={
+        404: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def get_conference(
+    request: Request,
+    qr_image: bool = True,
+    user: models.Principal = Depends(get_current_principal),
+):
+    # Everything the Delego app needs on launch: profile, MM registration and
+    # badge, inline as a data URI unless qr_image=false
+    try:
+        if user.role == "admin":
+            raise HTTPException(status_code=500, detail="You are an admin")
+        delegate, mm_delegate, versions = database.get_conference(user.id)
+        if not delegate:
+            raise HTTPException(status_code=404, detail="Delegate not found")
+        event = database.current_event()
+        headers = {
+            "ETag": f'W/"conference-{user.id}-{versions[0]}-{versions[1]}-{utils.qr_key_id()}-{int(qr_image)}"',
+            "Vary": "Authorization",
+        }
+        if not_modified(request, headers):
+            return Response(status_code=304, headers=headers)
+        qr = models.QRBadge(
+            payload=utils.sign_qr_payload(delegate.id, event),
+            url=f"{settings.url}/qr?id={delegate.id}",
+        )
+        if qr_image:
+            qr.image = utils.qr_data_uri(delegate.id, event)
+        return json_response(
+            models.Conference(profile=delegate, mumbaimun=mm_delegate, qr=qr), headers
+        )
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -375,17 +981,54 @@ def get_current_delegate(
     },
 )
 def get_delegate_by_id(
-    id: str, user: models.Delegate | models.Admin = Depends(get_current_user)
+    request: Request,
+    id: str,
+    fields: str = "",
+    user: models.Principal = Depends(get_current_principal),
 ):
     try:
-        if type(user) != models.Admin:
-            if type(user) == models.Delegate and user.id == id:
-                return user
+        if user.role != "admin" and user.id != id:
             raise HTTPException(status_code=403, detail="Forbidden")
-        data = database.get_delegate_by_id(id)
+        selected = parse_fields(fields, database.delegate_columns)
+        headers = cache_headers("delegates", id, *selected)
+        headers["Vary"] = "Authorization"
+        if not_modified(request, headers):
+            return Response(status_code=304, headers=headers)
+        if selected:
+            rows = database.get_delegates_fields(selected, id)
+            data = rows[0] if rows else None
+        else:
+            data = database.get_delegate_by_id(id)
         if data:
-            return data
+            return json_response(data, headers)
         raise HTTPException(status_code=404, detail="Delegate not found")
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post(
+    "/delegates/batch",
+    tags=["Admin"],
+    response_model=models.DelegateBatch,
+    responses={
+        400: {"model": models.ErrorResponse},
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def get_delegates_batch(
+    batch: models.BatchRequest,
+    user: models.Principal = Depends(get_current_principal),
+):
+    try:
+        if user.role != "admin":
+            raise HTTPException(status_code=403, detail="Forbidden")
+        check_batch_size(batch)
+        return json_response(database.get_delegates_batch(batch.ids, batch.emails))
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -402,7 +1045,7 @@ def get_delegate_by_id(
 )
 def update_delegate(
     id: str,
-    user: models.Delegate | models.Admin = Depends(get_current_user),
+    user: models.Principal = Depends(get_current_principal),
     firstname: str = "",
     lastname: str = "",
     contact: str = "",
@@ -412,27 +1055,29 @@ def update_delegate(
     verified: bool = False,
 ):
     try:
-        if type(user) != models.Admin:
-            if type(user) == models.Delegate and user.id != id:
-                raise HTTPException(status_code=403, detail="Forbidden")
-        data = database.get_delegate_by_id(id)
-        if not data:
-            raise HTTPException(status_code=404, detail="Delegate not found")
+        if user.role != "admin" and user.id != id:
+            raise HTTPException(status_code=403, detail="Forbidden")
+        fields = {}
         if firstname != "":
-            data.firstname = firstname
+            fields["firstname"] = firstname
         if lastname != "":
-            data.lastname = lastname
+            fields["lastname"] = lastname
         if contact != "":
-            data.contact = contact
+            fields["contact"] = contact
         if dateofbirth != "":
-            data.dateofbirth = dateofbirth
+            fields["dateofbirth"] = dateofbirth
         if gender != "":
-            data.gender = gender
+            fields["gender"] = gender
         if pastmuns != []:
-            data.pastmuns = pastmuns
+            fields["pastmuns"] = pastmuns
         if verified:
-            data.verified = verified
-        return database.update_delegate_by_id(id, data)
+            fields["verified"] = verified
+        data = database.patch_delegate(id, fields)
+        if not data:
+            raise HTTPException(status_code=404, detail="Delegate not found")
+        return data
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -442,28 +1087,124 @@ def update_delegate(
 # MUMBAIMUN QR CODES
 
 
-@app.get("/qr", tags=["QR"])
-def get_qr(id: str):
+@app.get(
+    "/qr",
+    tags=["QR"],
+    responses={
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def get_qr(
+    request: Request,
+    id: str,
+    user: models.Principal = Depends(get_current_principal),
+):
     try:
-        qr_folder = utils.qr_folder
-        if not os.path.exists(qr_folder):
-            os.makedirs(qr_folder)
-
-        qr_image = f"{qr_folder}/{id}.jpg"
-
-        if not os.path.exists(qr_image):
-            utils.generate_qr(id)
+        # A badge is signed for whoever asks, so only its delegate and admins
+        # may fetch it
+        if user.role != "admin" and user.id != id:
+            raise HTTPException(status_code=403, detail="Forbidden")
+        # QR images only change when the active signing key does
+        event = database.current_event()
+        headers = {
+            "ETag": f'W/"qr-{event}-{utils.qr_key_id()}-{id}"',
+            "Vary": "Authorization",
+        }
+        if not_modified(request, headers):
+            return Response(status_code=304, headers=headers)
+
+        qr_image = utils.qr_path(id, event)
         try:
-            return FileResponse(qr_image)
+            return FileResponse(qr_image, headers=headers)
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/qr/verify", tags=["QR"], response_model=models.QRVerification)
+def verify_qr(payload: str):
+    # Checks a scanned badge by its signature alone, no database lookup
+    verified = utils.verify_qr_payload(payload)
+    if not verified:
+        return models.QRVerification(valid=False)
+    id, event = verified
+    return models.QRVerification(valid=True, id=id, event=event)
+
+
 # REGISTER STUFF
 
-mm_router = APIRouter(prefix="/mumbaimun", tags=["Mumbai MUN"])
+# Event routes, served for every registered event under /events/{event} and
+# for Mumbai MUN under its original /mumbaimun prefix as well
+mm_router = APIRouter(tags=["Mumbai MUN"])
+
+
+async def path_event(event: str):
+    # async so the event is set in the request's context, where sync
+    # endpoints copy it from when they run in the threadpool
+    if not database.get_event(event):
+        raise HTTPException(status_code=404, detail="Event not found")
+    database.use_event(event)
+
+
+async def mumbaimun_event():
+    database.use_event(database.legacy_event)
+
+
+
+def add_mm_registration(
+    user: models.User,
+) -> tuple[bool, models.Delegate, models.MMDelegate]:
+    # bcrypt and the inserts, run in the threadpool
+    user.password = hash_password(user.password)
+    with database.transaction():
+        user_exists, delegate, mm_delegate = database.get_registration(user.email)
+
+        if user_exists and not delegate:
+            raise HTTPException(
+                status_code=400, detail="User exists but is not a delegate."
+            )
+        if mm_delegate:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Mumbai MUN Delegate already registered! ID: {mm_delegate.id}",
+            )
+
+        if not delegate:
+            uid = str(uuid.uuid4()).replace("-", "")
+            delegate = database.add_delegate(
+                models.Delegate(
+                    id=uid,
+                    firstname=user.firstname,
+                    lastname=user.lastname,
+                    email=user.email,
+                    verified=True,
+                )
+            )
+        elif not delegate.verified:
+            database.verify_delegate_email(delegate.email)
+            delegate.verified = True
+
+        if not user_exists:
+            database.add_user(user)
+
+        mm_delegate = database.add_mm_delegate(
+            models.MMDelegate(
+                id=delegate.id,
+                firstname=delegate.firstname,
+                lastname=delegate.lastname,
+                email=delegate.email,
+                contact=delegate.contact,
+                dateofbirth=delegate.dateofbirth,
+                gender=delegate.gender,
+                pastmuns=delegate.pastmuns,
+                verified=delegate.verified,
+            )
+        )
+    return user_exists, delegate, mm_delegate
 
 
 @mm_router.post(
@@ -477,42 +1218,11 @@ mm_router = APIRouter(prefix="/mumbaimun", tags=["Mumbai MUN"])
 )
 async def mm_register(request: Request, user: models.User):
     try:
-        user.password = hash_password(user.password)
-        user_exists = database.get_user_by_email(user.email)
+        user_exists, delegate, mm_delegate = await run_in_threadpool(
+            add_mm_registration, user
+        )
 
         if user_exists:
-            delegate = database.get_delegate_by_email(user.email)
-
-            if not delegate:
-                raise HTTPException(
-                    status_code=400, detail="User exists but is not a delegate."
-                )
-            if not delegate.verified:
-                delegate.verified = True
-                database.update_delegate_by_id(delegate.id, delegate)
-
-            mm_delegate = database.get_mm_delegate_by_email(user.email)
-
-            if mm_delegate:
-                raise HTTPException(
-                    status_code=409,
-                    detail=f"Mumbai MUN Delegate already registered! ID: {mm_delegate.id}",
-                )
-
-            mm_delegate = database.add_mm_delegate(
-                models.MMDelegate(
-                    id=delegate.id,
-                    firstname=delegate.firstname,
-                    lastname=delegate.lastname,
-                    email=delegate.email,
-                    contact=delegate.contact,
-                    dateofbirth=delegate.dateofbirth,
-                    gender=delegate.gender,
-                    pastmuns=delegate.pastmuns,
-                    verified=delegate.verified,
-                )
-            )
-
             return JSONResponse(
                 status_code=201,
                 content={
@@ -520,122 +1230,268 @@ async def mm_register(request: Request, user: models.User):
                 },
             )
 
-        else:
+        try:
+            await mails.send_verification_email(delegate)
+            return JSONResponse(
+                status_code=201,
+                content={"message": f"User with id {delegate.id} created successfully!"},
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
 
-            delegate = database.get_delegate_by_email(user.email)
-            if not delegate:
-                uid = str(uuid.uuid4()).replace("-", "")
-                delegate = database.add_delegate(
-                    models.Delegate(
-                        id=uid,
-                        firstname=user.firstname,
-                        lastname=user.lastname,
-                        email=user.email,
-                        verified=True,
-                    )
-                )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-            database.add_user(user)
 
-            if not delegate.verified:
-                delegate.verified = True
-                database.update_delegate_by_id(delegate.id, delegate)
-
-            mm_delegate = database.add_mm_delegate(
-                models.MMDelegate(
-                    id=delegate.id,
-                    firstname=delegate.firstname,
-                    lastname=delegate.lastname,
-                    email=delegate.email,
-                    contact=delegate.contact,
-                    dateofbirth=delegate.dateofbirth,
-                    gender=delegate.gender,
-                    pastmuns=delegate.pastmuns,
-                    verified=delegate.verified,
-                )
+@mm_router.get(
+    "/delegates",
+    tags=["Admin"],
+    response_model=list[models.MMDelegate],
+    responses={
+        403: {"model": models.ErrorResponse},
+        404: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def get_mm_delegates(
+    request: Request,
+    user: models.Delegate | models.Admin = Depends(get_current_user),
+    format: str = "",
+    fields: str = "",
+):
+    try:
+        if type(user) != models.Admin:
+            raise HTTPException(status_code=403, detail="Forbidden")
+        selected = parse_fields(fields, database.mm_delegate_columns)
+        headers = cache_headers("mm_delegates", format or "json", *selected)
+        if not_modified(request, headers):
+            return Response(status_code=304, headers=headers)
+
+        if selected:
+            return export_response(
+                request,
+                "mm_delegates",
+                format,
+                headers,
+                lambda: database.get_mm_delegates_fields(selected),
+                selected,
             )
+        return export_response(
+            request, "mm_delegates", format, headers, database.get_mm_delegates
+        )
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 
+@mm_router.post(
+    "/delegates/import",
+    tags=["Admin"],
+    response_model=models.ImportResult,
+    responses={
+        400: {"model": models.ErrorResponse},
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def import_mm_delegates(
+    background_tasks: BackgroundTasks,
+    file: UploadFile,
+    format: str = "",
+    send_verification: bool = False,
+    user: models.Delegate | models.Admin = Depends(get_current_user),
+):
+    try:
+        if type(user) != models.Admin:
+            raise HTTPException(status_code=403, detail="Forbidden")
+        format = import_format(file, format)
+        if format not in ("csv", "ndjson"):
+            raise HTTPException(status_code=400, detail="Format must be csv or ndjson")
+
+        mm_delegates = []
+        rows = {}
+        errors = []
+        for row, record, error in utils.iter_import_rows(file.file, format):
+            if error:
+                errors.append(models.ImportRowError(row=row, error=error))
+                continue
+            if not record.get("id"):
+                record["id"] = str(uuid.uuid4()).replace("-", "")
             try:
-                await mails.send_verification_email(delegate)
-                return JSONResponse(
-                    status_code=201,
-                    content={
-                        "message": f"User with id {delegate.id} created successfully!"
-                    },
+                mm_delegate = models.MMDelegate.model_validate(record)
+            except ValidationError as e:
+                errors.append(models.ImportRowError(row=row, error=validation_message(e)))
+                continue
+            if mm_delegate.id in rows or mm_delegate.email in rows:
+                errors.append(
+                    models.ImportRowError(row=row, error="Duplicate delegate in file")
                 )
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=str(e))
+                continue
+            rows[mm_delegate.id] = rows[mm_delegate.email] = row
+            mm_delegates.append(mm_delegate)
+
+        # MM delegates share their id with the base delegate profile, creating
+        # verified profiles for anyone who is not registered yet like mm_register
+        with database.transaction():
+            ids = database.get_delegate_ids_by_email([d.email for d in mm_delegates])
+            new_delegates = []
+            for mm_delegate in mm_delegates:
+                if mm_delegate.email in ids:
+                    mm_delegate.id = ids[mm_delegate.email]
+                else:
+                    mm_delegate.verified = True
+                    new_delegates.append(
+                        models.Delegate(
+                            id=mm_delegate.id,
+                            firstname=mm_delegate.firstname,
+                            lastname=mm_delegate.lastname,
+                            email=mm_delegate.email,
+                            contact=mm_delegate.contact,
+                            dateofbirth=mm_delegate.dateofbirth,
+                            gender=mm_delegate.gender,
+                            pastmuns=mm_delegate.pastmuns,
+                            verified=True,
+                        )
+                    )
 
+            skipped_emails = set()
+            for delegate in database.add_delegates(new_delegates):
+                skipped_emails.add(delegate.email)
+                errors.append(
+                    models.ImportRowError(
+                        row=rows[delegate.email], error="Delegate id already exists"
+                    )
+                )
+            mm_delegates = [d for d in mm_delegates if d.email not in skipped_emails]
+            skipped = database.add_mm_delegates(mm_delegates)
+            for mm_delegate in skipped:
+                errors.append(
+                    models.ImportRowError(
+                        row=rows[mm_delegate.email],
+                        error="Mumbai MUN Delegate already registered",
+                    )
+                )
+
+        errors.sort(key=lambda e: e.row)
+
+        if send_verification:
+            for delegate in new_delegates:
+                if delegate.email not in skipped_emails:
+                    background_tasks.add_task(mails.send_verification_email, delegate)
+
+        return models.ImportResult(
+            inserted=len(mm_delegates) - len(skipped), errors=errors
+        )
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @mm_router.get(
-    "/delegates",
+    "/unregistered",
     tags=["Admin"],
-    response_model=list[models.MMDelegate],
+    response_model=list[models.Delegate],
     responses={
         403: {"model": models.ErrorResponse},
-        404: {"model": models.ErrorResponse},
         500: {"model": models.ErrorResponse},
     },
 )
-async def get_mm_delegates(
-    user: models.Delegate | models.Admin = Depends(get_current_user), format: str = ""
+def get_mm_unregistered_delegates(
+    user: models.Delegate | models.Admin = Depends(get_current_user),
 ):
     try:
         if type(user) != models.Admin:
             raise HTTPException(status_code=403, detail="Forbidden")
+        return json_response(database.get_delegates_without_mm_registration())
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        data = database.get_mm_delegates()
-        if data:
-            if format == "csv":
-                output = StringIO()
-                writer = csv.writer(output)
-                writer.writerow(
-                    [
-                        "id",
-                        "firstname",
-                        "lastname",
-                        "email",
-                        "contact",
-                        "dateofbirth",
-                        "gender",
-                        "pastmuns",
-                    ]
-                )
 
-                for delegate in data:
-                    past_muns_info = []
-                    for mun in delegate.pastmuns:
-                        past_muns_info.append(
-                            f"{mun.name} | {mun.committee} | {mun.delegation} | {mun.year} | {mun.award}"
-                        )
+@mm_router.post(
+    "/delegates/batch",
+    tags=["Admin"],
+    response_model=models.MMDelegateBatch,
+    responses={
+        400: {"model": models.ErrorResponse},
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def get_mm_delegates_batch(
+    batch: models.BatchRequest,
+    user: models.Principal = Depends(get_current_principal),
+):
+    try:
+        if user.role != "admin":
+            raise HTTPException(status_code=403, detail="Forbidden")
+        check_batch_size(batch)
+        return json_response(database.get_mm_delegates_batch(batch.ids, batch.emails))
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-                    writer.writerow(
-                        [
-                            delegate.id,
-                            delegate.firstname,
-                            delegate.lastname,
-                            delegate.email,
-                            delegate.contact,
-                            delegate.dateofbirth,
-                            delegate.gender,
-                            " ; ".join(past_muns_info),
-                        ]
-                    )
 
-                csv_data = output.getvalue()
-                output.close()
+@mm_router.get(
+    "/delegates/unverified",
+    tags=["Admin"],
+    response_model=list[models.MMDelegate],
+    responses={
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def get_mm_unverified_delegates(
+    user: models.Delegate | models.Admin = Depends(get_current_user),
+):
+    try:
+        if type(user) != models.Admin:
+            raise HTTPException(status_code=403, detail="Forbidden")
+        return json_response(database.get_mm_delegates_with_unverified_profile())
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 
-                return Response(content=csv_data, media_type="text/csv")
-            return data
-        raise HTTPException(status_code=404, detail="No delegates found")
+@mm_router.get(
+    "/changes",
+    tags=["Admin"],
+    response_model=models.ChangePage,
+    responses={
+        403: {"model": models.ErrorResponse},
+        500: {"model": models.ErrorResponse},
+    },
+)
+def get_mm_changes(
+    since: int = 0,
+    limit: int = 500,
+    user: models.Principal = Depends(get_current_principal),
+):
+    try:
+        if user.role != "admin":
+            raise HTTPException(status_code=403, detail="Forbidden")
+        limit = max(1, min(limit, 1000))
+        return change_page(database.get_mm_changes(since, limit), since, limit)
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-app.include_router(mm_router)
+app.include_router(
+    mm_router, prefix="/mumbaimun", dependencies=[Depends(mumbaimun_event)]
+)
+app.include_router(
+    mm_router,
+    prefix="/events/{event}",
+    tags=["Events"],
+    dependencies=[Depends(path_event)],
+)
 
 #####################################
 # Changes related to food by Kartik #
@@ -647,23 +1503,51 @@ def scan(request: Request):
     return templates.TemplateResponse("scan.html", {"request": request})
 
 
+def badge_id(id: str, qr: str) -> str:
+    # The delegate a scan is for. /scan passes the badge payload as qr, forged
+    # badges are turned away before any lookup, and bare ids (as qr or id)
+    # only pass with QR_ACCEPT_UNSIGNED
+    if qr:
+        verified = utils.verify_qr_payload(qr)
+        if verified:
+            id, event = verified
+            if event != database.current_event():
+                raise HTTPException(
+                    status_code=403, detail="Badge is for another event"
+                )
+            return id
+        if settings.qr_accept_unsigned and "." not in qr:
+            return qr
+        raise HTTPException(status_code=403, detail="Invalid badge")
+    if not id:
+        raise HTTPException(status_code=400, detail="Missing badge")
+    if not settings.qr_accept_unsigned:
+        raise HTTPException(status_code=403, detail="Unsigned badges are not accepted")
+    return id
+
+
 @app.get("/food", tags=["Food"], response_class=HTMLResponse)
-def get_food(request: Request, id: str):
+def get_food(request: Request, id: str = "", qr: str = ""):
     try:
-        delegate = database.get_mm_delegate_by_id(id)
+        id = badge_id(id, qr)
+        delegate = database.get_scan_delegate(id)
         if not delegate:
             raise HTTPException(status_code=404, detail="Delegate not found")
 
+        # The form posts the badge back so the update is checked the same way
         return templates.TemplateResponse(
-            "food.html", {"request": request, "delegate": delegate}
+            "food.html", {"request": request, "delegate": delegate, "qr": qr or id}
         )
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/food", tags=["Food"], status_code=201)
 def update_food(
-    id: Annotated[str, Form()],
+    id: Annotated[str, Form()] = "",
+    qr: Annotated[str, Form()] = "",
     d1_bf: Annotated[bool, Form()] = True,
     d1_lunch: Annotated[bool, Form()] = False,
     d1_hitea: Annotated[bool, Form()] = False,
@@ -674,29 +1558,30 @@ def update_food(
     d3_lunch: Annotated[bool, Form()] = False,
     d3_hitea: Annotated[bool, Form()] = False,
 ):
-    # Fetch the existing delegate
-    delegate = database.get_mm_delegate_by_id(id)
-    if not delegate:
-        raise HTTPException(status_code=404, detail="Delegate not found")
-
-    delegate.d1_bf = d1_bf
-    delegate.d1_lunch = d1_lunch
-    delegate.d1_hitea = d1_hitea
-    delegate.d2_bf = d2_bf
-    delegate.d2_lunch = d2_lunch
-    delegate.d2_hitea = d2_hitea
-    delegate.d3_bf = d3_bf
-    delegate.d3_lunch = d3_lunch
-    delegate.d3_hitea = d3_hitea
-
+    id = badge_id(id, qr)
     try:
-        database.update_mm_delegate(delegate.id, delegate)
-        return JSONResponse(
-            status_code=201,
-            content={"message": "Food updated successfully"},
+        delegate = database.patch_mm_delegate(
+            id,
+            {
+                "d1_bf": d1_bf,
+                "d1_lunch": d1_lunch,
+                "d1_hitea": d1_hitea,
+                "d2_bf": d2_bf,
+                "d2_lunch": d2_lunch,
+                "d2_hitea": d2_hitea,
+                "d3_bf": d3_bf,
+                "d3_lunch": d3_lunch,
+                "d3_hitea": d3_hitea,
+            },
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if not delegate:
+        raise HTTPException(status_code=404, detail="Delegate not found")
+    return JSONResponse(
+        status_code=201,
+        content={"message": "Food updated successfully"},
+    )
 
 
 #####################################
@@ -707,13 +1592,9 @@ def update_food(
 @app.post("/manual_verify", tags=["OC"], status_code=201)
 def manual_verify(email: str):
     try:
-        delegate = database.get_delegate_by_email(email)
-        if not delegate:
+        if not database.verify_delegate_email(email):
             raise HTTPException(status_code=404, detail="Delegate not found")
 
-        delegate.verified = True
-        database.update_delegate_by_id(delegate.id, delegate)
-
         return JSONResponse(status_code=201, content={"message": "Email verified!"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -730,6 +1611,7 @@ def delete_user(user: models.Delegate | models.Admin = Depends(get_current_user)
         raise HTTPException(status_code=500, detail="You are an admin")
     try:
         database.delete_user(user.email)
+        revoke_tokens(user.email)
         return JSONResponse(
             status_code=200, content={"message": "Account deleted successfully"}
         )
@@ -0,0 +1,168 @@
+import base64
+import gzip
+import hashlib
+from functools import lru_cache
+import logging
+import mimetypes
+import os
+import sys
+import urllib.request
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+import exports
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Files in static/ are copied to static/dist/ under a content hashed name
+# (logo.jpg -> logo.1a2b3c4d5e.jpg) when a worker starts, with .gz and .br
+# variants for text files. Those names never change content, so /assets
+# serves them as immutable. Old builds are left in place because sent emails
+# keep linking to them.
+static_folder = os.path.join(os.path.dirname(__file__), "static")
+build_folder = os.path.join(static_folder, "dist")
+
+# StaticFiles checks its directory when it is mounted, before anything has
+# built the manifest
+os.makedirs(build_folder, exist_ok=True)
+
+logger = logging.getLogger("mundra.assets")
+
+compressible = {".css", ".html", ".js", ".json", ".map", ".svg", ".txt"}
+
+# Third party scripts pinned to a version and its subresource integrity
+# hash. `python assets.py vendor` saves them to static/vendor/, checks them
+# against the hash and prints the hash to pin when there is none yet. Until
+# the copy is saved asset_url points at the CDN, loaded with the hash
+vendor_sources = {
+    "vendor/zxing.min.js": (
+        "https://unpkg.com/@zxing/library@0.21.3/umd/index.min.js",
+        "",
+    ),
+}
+
+
+def _fingerprint(name: str, content: bytes) -> str:
+    root, ext = os.path.splitext(name)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:10]}{ext}"
+
+
+def _write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _sources() -> list[str]:
+    names = []
+    for folder, dirs, files in os.walk(static_folder):
+        if os.path.abspath(folder) == os.path.abspath(static_folder):
+            dirs[:] = [d for d in dirs if os.path.join(folder, d) != build_folder]
+        for file in files:
+            if not file.startswith("."):
+                path = os.path.join(folder, file)
+                names.append(os.path.relpath(path, static_folder).replace(os.sep, "/"))
+    return names
+
+
+@lru_cache
+def manifest() -> dict[str, str]:
+    # Logical name -> fingerprinted name, built once per process
+    built = {}
+    for name in _sources():
+        with open(os.path.join(static_folder, name), "rb") as f:
+            content = f.read()
+        fingerprinted = _fingerprint(name, content)
+        path = os.path.join(build_folder, fingerprinted)
+        if not os.path.exists(path):
+            if os.path.splitext(name)[1] in compressible:
+                _write(path + ".gz", gzip.compress(content, compresslevel=9, mtime=0))
+                if brotli:
+                    _write(path + ".br", brotli.compress(content, quality=11))
+            _write(path, content)
+            logger.info("Built asset %s", fingerprinted)
+        built[name] = fingerprinted
+    for name, (url, integrity) in vendor_sources.items():
+        if name not in built and not integrity:
+            logger.warning(
+                "%s is loaded from %s unverified, run python assets.py vendor",
+                name,
+                url,
+            )
+    return built
+
+
+def asset_url(name: str) -> str:
+    fingerprinted = manifest().get(name)
+    if fingerprinted:
+        return f"/assets/{fingerprinted}"
+    if name in vendor_sources:
+        return vendor_sources[name][0]
+    return f"/static/{name}"
+
+
+def asset_integrity(name: str) -> str:
+    # SRI hash for the script tag when asset_url falls back to the CDN,
+    # a served copy needs none
+    if name in vendor_sources and name not in manifest():
+        return vendor_sources[name][1]
+    return ""
+
+
+def _integrity(content: bytes) -> str:
+    return "sha384-" + base64.b64encode(hashlib.sha384(content).digest()).decode()
+
+
+class AssetFiles(StaticFiles):
+    # Serves the precompressed variant the client accepts, with long lived
+    # caching since a fingerprinted name always has the same content
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        path, encoding = exports.negotiate(
+            full_path, request_headers.get("accept-encoding", "")
+        )
+        response = FileResponse(
+            path,
+            status_code=status_code,
+            stat_result=os.stat(path) if encoding else stat_result,
+            media_type=mimetypes.guess_type(full_path)[0] or "text/plain",
+        )
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        if os.path.splitext(full_path)[1] in compressible:
+            response.headers["Vary"] = "Accept-Encoding"
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+def vendor():
+    for name, (url, integrity) in vendor_sources.items():
+        with urllib.request.urlopen(url, timeout=30) as response:
+            content = response.read()
+        if integrity and _integrity(content) != integrity:
+            sys.exit(f"{name}: {url} does not match {integrity}")
+        _write(os.path.join(static_folder, name), content)
+        print(f"{name}: {len(content)} bytes from {url}, {_integrity(content)}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["vendor"]:
+        vendor()
+    else:
+        print("usage: python assets.py vendor")
@@ -1,58 +1,169 @@
-import jwt, bcrypt, string, secrets, os
+import jwt, bcrypt, string, secrets, os, threading, time
 from datetime import datetime, timedelta, timezone
 from jwt.exceptions import InvalidTokenError, ExpiredSignatureError
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-import config, models, database
+import config, models, database, metrics
 
 settings = config.get_settings()
 
 SECRET_KEY = settings.secret_key
 ALGORITHM = "HS256"
 VERIFICATION_TOKEN_EXPIRE_MINUTES = settings.verification_token_expire_minutes
+ACCESS_TOKEN_EXPIRE_MINUTES = settings.access_token_expire_minutes
+REFRESH_TOKEN_EXPIRE_DAYS = settings.refresh_token_expire_days
+REVOCATION_REFRESH_SECONDS = settings.revocation_refresh_seconds
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> models.Delegate | models.Admin:
-    credentials_exception = HTTPException(
+# email -> revoked_at, tokens issued before that second are rejected. Every
+# worker keeps a copy and reloads what changed every REVOCATION_REFRESH_SECONDS
+_revocations: dict[str, int] = {}
+_revocations_loaded_at = 0.0
+_revocations_lock = threading.Lock()
+
+def _credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=403,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+def _load_revocations(force: bool = False):
+    global _revocations_loaded_at
+    if not force and time.time() - _revocations_loaded_at < REVOCATION_REFRESH_SECONDS:
+        return
+    with _revocations_lock:
+        now = time.time()
+        if not force and now - _revocations_loaded_at < REVOCATION_REFRESH_SECONDS:
+            return
+        # Overlap the previous window so a revocation committed while it was
+        # being read is picked up on this pass
+        since = max(int(_revocations_loaded_at) - REVOCATION_REFRESH_SECONDS, 0)
+        _revocations.update(database.get_token_revocations(since))
+        _revocations_loaded_at = now
+
+def is_revoked(email: str, issued_at: int) -> bool:
+    _load_revocations()
+    return issued_at < _revocations.get(email, 0)
+
+def revoke_tokens(email: str):
+    revoked_at = int(time.time())
+    database.revoke_tokens(email, revoked_at)
+    _revocations[email] = max(_revocations.get(email, 0), revoked_at)
+
+def _decode(token: str, type: str = "access") -> dict:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email = payload.get("sub")
-        if email is None:
-            raise credentials_exception
     except InvalidTokenError:
-        raise credentials_exception
+        raise _credentials_exception()
+    # Every token carries its type, so a verification or refresh token (or
+    # an untyped one from before types were added) never passes as access
+    if payload.get("sub") is None or payload.get("type") != type:
+        raise _credentials_exception()
+    if is_revoked(payload["sub"], payload.get("iat", 0)):
+        raise _credentials_exception()
+    return payload
+
+def _lookup_user(email: str) -> models.Delegate | models.Admin:
     admin = database.get_admin_by_email(email)
     if admin:
         return admin
     delegate = database.get_delegate_by_email(email)
     if not delegate:
-        raise credentials_exception
-    if not delegate.verified:
-        raise HTTPException(status_code=401, detail="Please verify your email!")
+        raise _credentials_exception()
     return delegate
 
-def create_access_token(data: dict) -> str:
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> models.Delegate | models.Admin:
+    payload = _decode(token)
+    user = _lookup_user(payload["sub"])
+    if type(user) == models.Delegate and not user.verified:
+        raise HTTPException(status_code=401, detail="Please verify your email!")
+    return user
+
+def principal_for(user: models.Delegate | models.Admin) -> models.Principal:
+    if type(user) == models.Admin:
+        return models.Principal(email=user.email, role="admin")
+    return models.Principal(
+        email=user.email, role="delegate", id=user.id, verified=user.verified
+    )
+
+async def get_current_principal(token: str = Depends(oauth2_scheme)) -> models.Principal:
+    # Authorizes from the token claims alone, only tokens without claims and
+    # delegates who were unverified when the token was issued hit the database
+    payload = _decode(token)
+    if "role" not in payload:
+        principal = principal_for(_lookup_user(payload["sub"]))
+    else:
+        principal = models.Principal(
+            email=payload["sub"],
+            role=payload["role"],
+            id=payload.get("id", ""),
+            verified=payload.get("verified", False),
+        )
+    if principal.role == "delegate" and not principal.verified:
+        delegate = database.get_delegate_by_email(principal.email)
+        if not delegate or not delegate.verified:
+            raise HTTPException(status_code=401, detail="Please verify your email!")
+        principal.verified = True
+    return principal
+
+def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
     to_encode = data.copy()
+    now = datetime.now(timezone.utc)
+    expire = now + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    to_encode.update({"iat": now, "exp": expire, "type": "access"})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def create_tokens(principal: models.Principal) -> models.Token:
+    access_token = create_access_token(
+        data={
+            "sub": principal.email,
+            "role": principal.role,
+            "id": principal.id,
+            "verified": principal.verified,
+        }
+    )
+    now = datetime.now(timezone.utc)
+    refresh_token = jwt.encode(
+        {
+            "sub": principal.email,
+            "type": "refresh",
+            "iat": now,
+            "exp": now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+        },
+        SECRET_KEY,
+        algorithm=ALGORITHM,
+    )
+    return models.Token(
+        access_token=access_token,
+        token_type="bearer",
+        refresh_token=refresh_token,
+        expires_in=ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    )
+
+def refresh_tokens(refresh_token: str) -> models.Token:
+    # Refreshing is rare, so check the revocation list as it is right now and
+    # reissue the claims from the current database state
+    _load_revocations(force=True)
+    payload = _decode(refresh_token, "refresh")
+    return create_tokens(principal_for(_lookup_user(payload["sub"])))
+
 def create_verification_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + timedelta(minutes=VERIFICATION_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "type": "verify"})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+@metrics.timed("auth")
 def hash_password(password: str) -> str:
     salt = bcrypt.gensalt()
     hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
     return hashed_password.decode('utf-8')
 
+@metrics.timed("auth")
 def verify_password(password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
 
@@ -65,7 +176,7 @@ async def check_verification_token(token: str = Depends(oauth2_scheme)) -> model
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email = payload.get("sub")
-        if email is None:
+        if email is None or payload.get("type") != "verify":
             raise credentials_exception
     except ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Verification token expired")
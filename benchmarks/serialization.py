@@ -0,0 +1,62 @@
+# Compares FastAPI's default response path with the pydantic-core path used
+# by app.json_response for a list of delegates.
+#
+#   python benchmarks/serialization.py [count]
+
+import sys
+import timeit
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+from pydantic_core import to_json
+
+sys.path.insert(0, ".")
+import models
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+
+delegates = [
+    models.MMDelegate(
+        id=f"{i:032x}",
+        firstname=f"First{i}",
+        lastname=f"Last{i}",
+        email=f"delegate{i}@example.com",
+        contact="9999999999",
+        dateofbirth="2004-01-01",
+        gender="F",
+        pastmuns=[
+            models.MunExperience(
+                name="Mumbai MUN", committee="DISEC", delegation="India", year=2023
+            )
+        ],
+        country="India",
+        committee="UNSC",
+    )
+    for i in range(count)
+]
+field = create_model_field(name="Response", type_=list[models.MMDelegate])
+
+
+async def default_path():
+    content = await serialize_response(field=field, response_content=delegates)
+    return JSONResponse(content=content).body
+
+
+def fast_path():
+    return to_json(delegates)
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    assert len(asyncio.run(default_path())) > 0
+    runs = 5
+    default = min(
+        timeit.repeat(lambda: asyncio.run(default_path()), number=1, repeat=runs)
+    )
+    fast = min(timeit.repeat(fast_path, number=1, repeat=runs))
+    print(f"{count} delegates")
+    print(f"default (response_model validation + json.dumps): {default * 1000:.1f} ms")
+    print(f"pydantic-core to_json:                          {fast * 1000:.1f} ms")
+    print(f"speedup: {default / fast:.1f}x")
@@ -4,6 +4,10 @@ from functools import lru_cache
 class Settings(BaseSettings):
     secret_key: str
     verification_token_expire_minutes: int = 120
+    access_token_expire_minutes: int = 15
+    refresh_token_expire_days: int = 30
+    # How stale a worker's copy of the token revocation list may get
+    revocation_refresh_seconds: int = 30
     tech_email: str = "technology@munsocietympstme.com"
     support_email: str = "contact@munsocietympstme.com"
     url: str = "http://localhost:8000"
@@ -15,6 +19,51 @@ class Settings(BaseSettings):
     mail_server: str
     docs_url: str | None = None
     redoc_url: str = "/docs"
+    # Serve cached /stats for this long without checking for writes
+    stats_refresh_seconds: int = 0
+    # Bearer token required by /metrics, which answers 403 while it is empty
+    metrics_token: str = ""
+    # SQL statements slower than this are logged
+    slow_query_ms: int = 100
+    log_level: str = "INFO"
+    # Event served by routes outside /events/{event}, such as /food and /stats
+    default_event: str = "mumbaimun"
+    # How long a response is replayed for a repeated Idempotency-Key
+    idempotency_ttl_seconds: int = 86400
+    # Endpoint class -> [concurrent requests, queued requests, max seconds
+    # queued], see admission.py for the classes
+    admission_limits: dict[str, list[float]] = {
+        "scan": [24, 256, 5],
+        "auth": [4, 64, 10],
+        "export": [2, 8, 30],
+        "qr": [4, 32, 5],
+        "other": [6, 128, 10],
+    }
+
+    # Key id -> secret for signing badge QR codes. New badges are signed with
+    # qr_active_key (the last key listed when empty), the other keys still
+    # verify until removed. Key ids are short and alphanumeric. Without keys
+    # one derived from secret_key is used under the id "0"
+    qr_signing_keys: dict[str, str] = {}
+    qr_active_key: str = ""
+    # Accept bare delegate ids from badges printed before QR codes were signed
+    qr_accept_unsigned: bool = False
+
+    # Fraction of requests run under the sampling profiler, admins can also
+    # profile a single request with an X-Profile: 1 header
+    profile_sample_rate: float = 0.0
+    profile_interval_ms: int = 5
+    # Profiles kept in profiles/, the oldest are removed first
+    profile_keep: int = 50
+
+    # Fraction of requests traced to traces/<pid>.jsonl, off when 0
+    trace_sample_rate: float = 0.0
+    # Size of a trace file before it is rotated, and rotated files kept
+    trace_max_bytes: int = 10 * 1024 * 1024
+    trace_backups: int = 5
+
+    # Most ids and emails accepted by one batch lookup
+    batch_lookup_limit: int = 1000
 
     model_config = SettingsConfigDict(env_file=".env")
 
@@ -1,8 +1,17 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import logging
 import os
 import sqlite3
+import threading
+import time
 import zipfile
 
+import config
+import metrics
 import models
+import querylog
 
 db = os.path.join(os.path.dirname(__file__), "databases", "main.db")
 backup_db = os.path.join(os.path.dirname(__file__), "backups", "backup.db")
@@ -12,6 +21,366 @@ mm_backup_db = os.path.join(os.path.dirname(__file__), "backups", "mm_backup.db"
 
 db_zip = os.path.join(os.path.dirname(__file__), "backups", "backup_db.zip")
 
+# Every event (conference) keeps its mm_delegates table in its own shard,
+# databases/events/<slug>.db, created and migrated the first time it is used.
+# Mumbai MUN predates the registry and stays in mm.db
+events_folder = os.path.join(os.path.dirname(__file__), "databases", "events")
+legacy_event = "mumbaimun"
+
+settings = config.get_settings()
+
+logger = logging.getLogger("mundra.database")
+
+# SQLite's default limit on bound parameters is 999 on older builds
+max_query_params = 500
+
+
+def _chunks(items: list, size: int = max_query_params):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _pastmuns_to_str(pastmuns: list[models.MunExperience]) -> str:
+    return "".join(
+        f"{mun.name},{mun.committee},{mun.delegation},{mun.year},{mun.award};"
+        for mun in pastmuns
+    )
+
+
+def _pastmuns_from_str(pastmuns: str) -> list[models.MunExperience]:
+    mun_list = []
+    if pastmuns:
+        for mun in pastmuns.split(";"):
+            m = mun.split(",")
+            if m != [""]:
+                mun_list.append(
+                    models.MunExperience(
+                        name=m[0],
+                        committee=m[1],
+                        delegation=m[2],
+                        year=int(m[3]),
+                        award=m[4],
+                    )
+                )
+    return mun_list
+
+
+def _delegate_from_row(row: tuple) -> models.Delegate:
+    return models.Delegate(
+        id=row[0],
+        firstname=row[1],
+        lastname=row[2],
+        email=row[3],
+        contact=row[4],
+        dateofbirth=row[5],
+        gender=row[6],
+        pastmuns=_pastmuns_from_str(row[7]),
+        verified=row[8],
+    )
+
+
+def _mm_delegate_from_row(row: tuple) -> models.MMDelegate:
+    return models.MMDelegate(
+        id=row[0],
+        firstname=row[1],
+        lastname=row[2],
+        email=row[3],
+        contact=row[4],
+        dateofbirth=row[5],
+        gender=row[6],
+        pastmuns=_pastmuns_from_str(row[7]),
+        verified=row[8],
+        country=row[9],
+        committee=row[10],
+        d1_bf=bool(row[11]),
+        d1_lunch=bool(row[12]),
+        d1_hitea=bool(row[13]),
+        d2_bf=bool(row[14]),
+        d2_lunch=bool(row[15]),
+        d2_hitea=bool(row[16]),
+        d3_bf=bool(row[17]),
+        d3_lunch=bool(row[18]),
+        d3_hitea=bool(row[19]),
+    )
+
+
+delegate_columns = (
+    "firstname",
+    "lastname",
+    "email",
+    "contact",
+    "dateofbirth",
+    "gender",
+    "pastmuns",
+    "verified",
+)
+
+# Meal flags of an MM delegate, in the order stats report them and the scan
+# index packs them as bits
+meal_columns = (
+    "d1_bf",
+    "d1_lunch",
+    "d1_hitea",
+    "d2_bf",
+    "d2_lunch",
+    "d2_hitea",
+    "d3_bf",
+    "d3_lunch",
+    "d3_hitea",
+)
+
+mm_delegate_columns = (
+    *delegate_columns,
+    "country",
+    "committee",
+    *meal_columns,
+)
+
+
+bool_columns = {"verified", *meal_columns}
+
+
+def _select_fields(
+    cursor: sqlite3.Cursor,
+    table: str,
+    columns: tuple[str, ...],
+    fields: list[str],
+    id: str | None = None,
+) -> list[dict]:
+    # Reads only the requested columns, pastmuns is decoded only when asked for
+    unknown = set(fields) - {"id", *columns}
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    sql = f"SELECT {', '.join(fields)} FROM {table}"
+    if id is None:
+        cursor.execute(sql)
+    else:
+        cursor.execute(sql + " WHERE id = ?", (id,))
+    decoders = []
+    for i, field in enumerate(fields):
+        if field == "pastmuns":
+            decoders.append((i, lambda v: [m.model_dump() for m in _pastmuns_from_str(v)]))
+        elif field in bool_columns:
+            decoders.append((i, bool))
+        else:
+            decoders.append((i, lambda v: "" if v is None else v))
+    return [
+        {field: decode(row[i]) for field, (i, decode) in zip(fields, decoders)}
+        for row in cursor.fetchall()
+    ]
+
+
+def _batch_lookup(
+    cursor: sqlite3.Cursor, table: str, ids: list[str], emails: list[str]
+) -> tuple[list[tuple], list[str], list[str]]:
+    # Rows for the ids then the emails in request order, each delegate once,
+    # plus the ids and emails that matched nothing
+    by_column = {}
+    for column, index, values in (("id", 0, ids), ("email", 3, emails)):
+        found = by_column[column] = {}
+        for chunk in _chunks(list(dict.fromkeys(values))):
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(
+                f"SELECT * FROM {table} WHERE {column} IN ({placeholders})", chunk
+            )
+            for row in cursor.fetchall():
+                found[row[index]] = row
+    rows = []
+    seen = set()
+    missing = {"id": [], "email": []}
+    for column, values in (("id", ids), ("email", emails)):
+        for value in values:
+            row = by_column[column].get(value)
+            if row is None:
+                missing[column].append(value)
+            elif row[0] not in seen:
+                seen.add(row[0])
+                rows.append(row)
+    return rows, missing["id"], missing["email"]
+
+
+def _patch_row(
+    cursor: sqlite3.Cursor, table: str, columns: tuple[str, ...], id: str, fields: dict
+) -> tuple | None:
+    # Writes only the given columns and reads the row back in the same statement
+    unknown = set(fields) - set(columns)
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(sorted(unknown))}")
+    if "pastmuns" in fields:
+        fields = {**fields, "pastmuns": _pastmuns_to_str(fields["pastmuns"])}
+    if not fields:
+        cursor.execute(f"SELECT * FROM {table} WHERE id = ?", (id,))
+    else:
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        cursor.execute(
+            f"UPDATE {table} SET {assignments} WHERE id = ? RETURNING *",
+            (*fields.values(), id),
+        )
+    return cursor.fetchone()
+
+
+insert_delegate_sql = """INSERT INTO delegates
+    (id, firstname, lastname, email, contact, dateofbirth, gender, pastmuns, verified)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+insert_mm_delegate_sql = """INSERT INTO mm_delegates
+    (id, firstname, lastname, email, contact, dateofbirth, gender, pastmuns, verified, country, committee, d1_bf, d1_lunch, d1_hitea, d2_bf, d2_lunch, d2_hitea, d3_bf, d3_lunch, d3_hitea, registered_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)"""
+
+
+def _delegate_params(delegate: models.Delegate) -> tuple:
+    return (
+        delegate.id,
+        delegate.firstname,
+        delegate.lastname,
+        delegate.email,
+        delegate.contact,
+        delegate.dateofbirth,
+        delegate.gender,
+        _pastmuns_to_str(delegate.pastmuns),
+        delegate.verified,
+    )
+
+
+def _mm_delegate_params(mm_delegate: models.MMDelegate) -> tuple:
+    return (
+        mm_delegate.id,
+        mm_delegate.firstname,
+        mm_delegate.lastname,
+        mm_delegate.email,
+        mm_delegate.contact,
+        mm_delegate.dateofbirth,
+        mm_delegate.gender,
+        _pastmuns_to_str(mm_delegate.pastmuns),
+        mm_delegate.verified,
+        mm_delegate.country,
+        mm_delegate.committee,
+        mm_delegate.d1_bf,
+        mm_delegate.d1_lunch,
+        mm_delegate.d1_hitea,
+        mm_delegate.d2_bf,
+        mm_delegate.d2_lunch,
+        mm_delegate.d2_hitea,
+        mm_delegate.d3_bf,
+        mm_delegate.d3_lunch,
+        mm_delegate.d3_hitea,
+    )
+
+
+_event: ContextVar[str | None] = ContextVar("event", default=None)
+
+
+def current_event() -> str:
+    # Set per request by the /events/{event} and /mumbaimun routers, other
+    # routes use the configured default event
+    return _event.get() or settings.default_event
+
+
+def use_event(slug: str):
+    _event.set(slug)
+
+
+def event_db(slug: str) -> str:
+    if slug == legacy_event:
+        return mm_db
+    return os.path.join(events_folder, f"{slug}.db")
+
+
+def table_scope(table: str) -> str:
+    # Event tables exist once per shard, so their versions are per event too
+    if table == "mm_delegates":
+        return f"{current_event()}-{table}"
+    return table
+
+
+_ready_events: set[str] = set()
+
+# Idle connections per event, reused by later units of work
+pool_size = 8
+_pools: dict[str, list[sqlite3.Connection]] = {}
+_pools_lock = threading.Lock()
+
+
+def _connect(event: str) -> sqlite3.Connection:
+    # main.db with the event's shard attached as "mm", so one connection can
+    # join and write both. Unqualified mm_delegates still resolves to
+    # mm.mm_delegates. Commits spanning both files are atomic only in rollback
+    # journal mode, so no database may be switched to WAL.
+    if event not in _ready_events:
+        init_event(event)
+        _ready_events.add(event)
+    connection = sqlite3.connect(
+        db, factory=querylog.ProfiledConnection, check_same_thread=False
+    )
+    connection.execute("ATTACH DATABASE ? AS mm", (event_db(event),))
+    return connection
+
+
+def _acquire(event: str) -> sqlite3.Connection:
+    with _pools_lock:
+        pool = _pools.get(event)
+        if pool:
+            return pool.pop()
+    return _connect(event)
+
+
+def _release(event: str, connection: sqlite3.Connection):
+    with _pools_lock:
+        pool = _pools.setdefault(event, [])
+        if len(pool) < pool_size:
+            pool.append(connection)
+            return
+    connection.close()
+
+
+_transaction: ContextVar[sqlite3.Connection | None] = ContextVar(
+    "transaction", default=None
+)
+_rollback_callbacks: ContextVar[list | None] = ContextVar(
+    "rollback_callbacks", default=None
+)
+
+
+@contextmanager
+def transaction():
+    # Unit of work: every database function called inside the block shares one
+    # connection, and everything commits once when the outermost block exits
+    # or rolls back together if it raises
+    connection = _transaction.get()
+    if connection is not None:
+        yield connection
+        return
+    event = current_event()
+    connection = _acquire(event)
+    token = _transaction.set(connection)
+    callbacks = []
+    callbacks_token = _rollback_callbacks.set(callbacks)
+    try:
+        with connection:
+            yield connection
+    except BaseException:
+        for callback in callbacks:
+            callback()
+        raise
+    finally:
+        _rollback_callbacks.reset(callbacks_token)
+        _transaction.reset(token)
+        _release(event, connection)
+
+
+def on_rollback(callback):
+    # Runs callback if the current transaction rolls back, for in-memory
+    # state updated ahead of the commit
+    _rollback_callbacks.get().append(callback)
+
+
+def _add_column_if_missing(
+    cursor: sqlite3.Cursor, table: str, column: str, definition: str
+):
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
 
 def init_admins():
     try:
@@ -23,9 +392,9 @@ def init_admins():
                 password TEXT NOT NULL)"""
             )
             connection.commit()
-            print("Database initialized successfully")
-    except sqlite3.Error as e:
-        print("Error initializing database:", e)
+            logger.debug("Database initialized successfully")
+    except sqlite3.Error:
+        logger.exception("Error initializing database")
 
 
 def init_users():
@@ -40,9 +409,51 @@ def init_users():
                 FOREIGN KEY(email) REFERENCES delegates(email) ON UPDATE CASCADE ON DELETE CASCADE)"""
             )
             connection.commit()
-            print("Database initialized successfully")
-    except sqlite3.Error as e:
-        print("Error initializing database:", e)
+            logger.debug("Database initialized successfully")
+    except sqlite3.Error:
+        logger.exception("Error initializing database")
+
+
+def init_token_revocations():
+    # One row per account, tokens issued before revoked_at are rejected
+    try:
+        with sqlite3.connect(db) as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS token_revocations
+                (email TEXT PRIMARY KEY NOT NULL,
+                revoked_at INTEGER NOT NULL)"""
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS token_revocations_revoked_at ON token_revocations (revoked_at)"
+            )
+            connection.commit()
+            logger.debug("Database initialized successfully")
+    except sqlite3.Error:
+        logger.exception("Error initializing database")
+
+
+def init_idempotency_keys():
+    try:
+        with sqlite3.connect(db) as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS idempotency_keys
+                (key TEXT PRIMARY KEY NOT NULL,
+                fingerprint TEXT NOT NULL,
+                state TEXT NOT NULL,
+                status INTEGER,
+                headers TEXT,
+                body BLOB,
+                created_at INTEGER NOT NULL)"""
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS idempotency_keys_created_at ON idempotency_keys (created_at)"
+            )
+            connection.commit()
+            logger.debug("Database initialized successfully")
+    except sqlite3.Error:
+        logger.exception("Error initializing database")
 
 
 def init_delegates():
@@ -61,15 +472,21 @@ def init_delegates():
                 pastmuns TEXT,
                 verified BOOLEAN DEFAULT 0)"""
             )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS delegates_verified_gender ON delegates (verified, gender)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS delegates_email ON delegates (email)"
+            )
             connection.commit()
-            print("Database initialized successfully")
-    except sqlite3.Error as e:
-        print("Error initializing database:", e)
+            logger.debug("Database initialized successfully")
+    except sqlite3.Error:
+        logger.exception("Error initializing database")
 
 
-def init_mm_delegates():
+def init_mm_delegates(database: str = mm_db):
     try:
-        with sqlite3.connect(mm_db) as connection:
+        with sqlite3.connect(database) as connection:
             cursor = connection.cursor()
             cursor.execute(
                 """CREATE TABLE IF NOT EXISTS mm_delegates(id TEXT PRIMARY KEY NOT NULL,
@@ -91,27 +508,401 @@ def init_mm_delegates():
                 d2_hitea BOOLEAN DEFAULT 0,
                 d3_bf BOOLEAN DEFAULT 0,
                 d3_lunch BOOLEAN DEFAULT 0,
-                d3_hitea BOOLEAN DEFAULT 0
+                d3_hitea BOOLEAN DEFAULT 0,
+                registered_at TEXT
                 )"""
             )
+            _add_column_if_missing(cursor, "mm_delegates", "registered_at", "TEXT")
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS mm_delegates_committee_country ON mm_delegates (committee, country)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS mm_delegates_gender ON mm_delegates (gender)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS mm_delegates_registered_at ON mm_delegates (registered_at)"
+            )
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS mm_delegates_email ON mm_delegates (email)"
+            )
+            connection.commit()
+            logger.debug("Database initialized successfully")
+    except sqlite3.Error:
+        logger.exception("Error initializing database")
+
+
+def init_data_versions(database: str, tables: list[str]):
+    # Every write to a tracked table bumps its version, so readers can tell
+    # whether anything changed with a single primary key lookup
+    try:
+        with sqlite3.connect(database) as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS data_versions
+                (name TEXT PRIMARY KEY NOT NULL,
+                version INTEGER NOT NULL DEFAULT 0,
+                updated_at INTEGER)"""
+            )
+            for table in tables:
+                for event in ("INSERT", "UPDATE", "DELETE"):
+                    cursor.execute(
+                        f"""CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()}
+                        AFTER {event} ON {table}
+                        BEGIN
+                            INSERT INTO data_versions (name, version, updated_at)
+                            VALUES ('{table}', 1, CAST(strftime('%s', 'now') AS INTEGER))
+                            ON CONFLICT(name) DO UPDATE
+                            SET version = version + 1, updated_at = excluded.updated_at;
+                        END"""
+                    )
+            connection.commit()
+    except sqlite3.Error:
+        logger.exception("Error initializing database")
+
+
+def init_changes(database: str, tables: dict[str, str]):
+    # Change feed: one row per (table, key) holding its latest change. Writes
+    # replace the row, so it moves to a new, higher seq, and deletes leave a
+    # tombstone. tables maps each tracked table to its key column
+    now = "CAST(strftime('%s', 'now') AS INTEGER)"
+    try:
+        with sqlite3.connect(database) as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'changes'"
+            )
+            exists = cursor.fetchone() is not None
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS changes
+                (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                tbl TEXT NOT NULL,
+                key TEXT NOT NULL,
+                op TEXT NOT NULL,
+                changed_at INTEGER NOT NULL,
+                UNIQUE (tbl, key))"""
+            )
+            for table, key in tables.items():
+                cursor.execute(
+                    f"""CREATE TRIGGER IF NOT EXISTS {table}_changes_insert AFTER INSERT ON {table}
+                    BEGIN
+                        INSERT OR REPLACE INTO changes (tbl, key, op, changed_at)
+                        VALUES ('{table}', new.{key}, 'upsert', {now});
+                    END"""
+                )
+                cursor.execute(
+                    f"""CREATE TRIGGER IF NOT EXISTS {table}_changes_update AFTER UPDATE ON {table}
+                    BEGIN
+                        INSERT OR REPLACE INTO changes (tbl, key, op, changed_at)
+                        SELECT '{table}', old.{key}, 'delete', {now} WHERE old.{key} != new.{key};
+                        INSERT OR REPLACE INTO changes (tbl, key, op, changed_at)
+                        VALUES ('{table}', new.{key}, 'upsert', {now});
+                    END"""
+                )
+                cursor.execute(
+                    f"""CREATE TRIGGER IF NOT EXISTS {table}_changes_delete AFTER DELETE ON {table}
+                    BEGIN
+                        INSERT OR REPLACE INTO changes (tbl, key, op, changed_at)
+                        VALUES ('{table}', old.{key}, 'delete', {now});
+                    END"""
+                )
+                if not exists:
+                    cursor.execute(
+                        f"""INSERT OR IGNORE INTO changes (tbl, key, op, changed_at)
+                        SELECT '{table}', {key}, 'upsert', {now} FROM {table}"""
+                    )
             connection.commit()
-            print("Database initialized successfully")
-    except sqlite3.Error as e:
-        print("Error initializing database:", e)
+    except sqlite3.Error:
+        logger.exception("Error initializing database")
+
+
+def init_search(database: str, table: str, columns: list[str]):
+    # External content FTS5 index kept in sync by triggers. It is keyed on the
+    # implicit rowid, so run rebuild_search_index after a VACUUM
+    cols = ", ".join(columns)
+    new_cols = ", ".join(f"new.{c}" for c in columns)
+    old_cols = ", ".join(f"old.{c}" for c in columns)
+    try:
+        with sqlite3.connect(database) as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                (f"{table}_fts",),
+            )
+            exists = cursor.fetchone() is not None
+            cursor.execute(
+                f"""CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5
+                ({cols}, content='{table}', content_rowid='rowid',
+                prefix='2 3', tokenize='unicode61 remove_diacritics 2')"""
+            )
+            cursor.execute(
+                f"""CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table}
+                BEGIN
+                    INSERT INTO {table}_fts (rowid, {cols}) VALUES (new.rowid, {new_cols});
+                END"""
+            )
+            cursor.execute(
+                f"""CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table}
+                BEGIN
+                    INSERT INTO {table}_fts ({table}_fts, rowid, {cols})
+                    VALUES ('delete', old.rowid, {old_cols});
+                END"""
+            )
+            # Only edits to indexed columns touch the index, older databases
+            # have a trigger that fired on every update
+            cursor.execute(f"DROP TRIGGER IF EXISTS {table}_fts_update")
+            cursor.execute(
+                f"""CREATE TRIGGER {table}_fts_update AFTER UPDATE OF {cols} ON {table}
+                BEGIN
+                    INSERT INTO {table}_fts ({table}_fts, rowid, {cols})
+                    VALUES ('delete', old.rowid, {old_cols});
+                    INSERT INTO {table}_fts (rowid, {cols}) VALUES (new.rowid, {new_cols});
+                END"""
+            )
+            if not exists:
+                logger.info("Building search index %s_fts", table)
+                cursor.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+            connection.commit()
+    except sqlite3.Error:
+        logger.exception("Error initializing database")
+
+
+def rebuild_search_index():
+    with transaction() as connection:
+        connection.execute("INSERT INTO delegates_fts (delegates_fts) VALUES ('rebuild')")
+        connection.execute(
+            "INSERT INTO mm_delegates_fts (mm_delegates_fts) VALUES ('rebuild')"
+        )
+
+
+def init_events():
+    try:
+        with sqlite3.connect(db) as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                """CREATE TABLE IF NOT EXISTS events
+                (slug TEXT PRIMARY KEY NOT NULL,
+                name TEXT NOT NULL,
+                created_at TEXT DEFAULT CURRENT_TIMESTAMP)"""
+            )
+            cursor.execute(
+                "INSERT OR IGNORE INTO events (slug, name) VALUES (?, ?)",
+                (legacy_event, "Mumbai MUN"),
+            )
+            cursor.execute(
+                "INSERT OR IGNORE INTO events (slug, name) VALUES (?, ?)",
+                (settings.default_event, settings.default_event),
+            )
+            connection.commit()
+            logger.debug("Database initialized successfully")
+    except sqlite3.Error:
+        logger.exception("Error initializing database")
+
+
+def init_event(slug: str):
+    # Creates or migrates an event shard, safe to run on every start
+    database = event_db(slug)
+    os.makedirs(os.path.dirname(database), exist_ok=True)
+    init_mm_delegates(database)
+    init_data_versions(database, ["mm_delegates"])
+    init_changes(database, {"mm_delegates": "id"})
+    init_search(
+        database,
+        "mm_delegates",
+        ["firstname", "lastname", "email", "country", "committee"],
+    )
 
 
 def init():
     init_admins()
     init_users()
+    init_token_revocations()
+    init_idempotency_keys()
     init_delegates()
-    init_mm_delegates()
+    init_events()
+    init_data_versions(db, ["users", "delegates"])
+    init_changes(db, {"users": "email", "delegates": "id"})
+    init_search(db, "delegates", ["firstname", "lastname", "email", "contact"])
+    for slug in (legacy_event, settings.default_event):
+        init_event(slug)
+        _ready_events.add(slug)
+
+
+####################
+# DATA VERSIONS
+####################
+
+
+@metrics.timed("database")
+def get_data_version(table: str) -> tuple[int, int | None]:
+    # Returns (version, unix time of the last write) for a tracked table
+    schema = "mm" if table == "mm_delegates" else "main"
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            f"SELECT version, updated_at FROM {schema}.data_versions WHERE name = ?",
+            (table,),
+        )
+        row = cursor.fetchone()
+        if row:
+            return row[0], row[1]
+        return 0, None
+
+
+####################
+# CHANGE FEED
+####################
+
+
+def _change_from_row(row: tuple, from_row) -> models.Change:
+    return models.Change(
+        seq=row[0],
+        table=row[1],
+        key=row[2],
+        op=row[3],
+        changed_at=row[4],
+        data=from_row(row[5:]) if row[5] is not None else None,
+    )
+
+
+@metrics.timed("database")
+def get_changes(since: int, limit: int) -> list[models.Change]:
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            """SELECT c.seq, c.tbl, c.key, c.op, c.changed_at, d.*
+            FROM main.changes c
+            LEFT JOIN main.delegates d
+            ON c.tbl = 'delegates' AND c.op = 'upsert' AND d.id = c.key
+            WHERE c.seq > ? ORDER BY c.seq LIMIT ?""",
+            (since, limit),
+        )
+        return [_change_from_row(row, _delegate_from_row) for row in cursor.fetchall()]
+
+
+@metrics.timed("database")
+def get_mm_changes(since: int, limit: int) -> list[models.Change]:
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            """SELECT c.seq, c.tbl, c.key, c.op, c.changed_at, d.*
+            FROM mm.changes c
+            LEFT JOIN mm.mm_delegates d ON c.op = 'upsert' AND d.id = c.key
+            WHERE c.seq > ? ORDER BY c.seq LIMIT ?""",
+            (since, limit),
+        )
+        return [
+            _change_from_row(row, _mm_delegate_from_row) for row in cursor.fetchall()
+        ]
+
+
+####################
+# EVENTS
+####################
+
+_events: dict[str, models.Event] = {}
+
+
+@metrics.timed("database")
+def get_event(slug: str) -> models.Event | None:
+    # Events are only ever added, so a found one is cached for good
+    event = _events.get(slug)
+    if event:
+        return event
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT slug, name FROM events WHERE slug = ?", (slug,))
+        row = cursor.fetchone()
+    if not row:
+        return None
+    event = _events[slug] = models.Event(slug=row[0], name=row[1])
+    return event
+
+
+@metrics.timed("database")
+def get_events() -> list[models.Event]:
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT slug, name FROM events ORDER BY created_at, slug")
+        return [models.Event(slug=row[0], name=row[1]) for row in cursor.fetchall()]
+
+
+@metrics.timed("database")
+def add_event(event: models.Event) -> models.Event:
+    init_event(event.slug)
+    _ready_events.add(event.slug)
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            "INSERT INTO events (slug, name) VALUES (?, ?)", (event.slug, event.name)
+        )
+    return event
+
+
+####################
+# IDEMPOTENCY KEYS
+####################
+
+_idempotency_pruned_at = 0.0
+
+
+@metrics.timed("database")
+def claim_idempotency_key(key: str, fingerprint: str, ttl: int) -> tuple | None:
+    # Returns None when the key was free (or expired) and is now pending for
+    # this request, otherwise the stored (fingerprint, state, status, headers,
+    # body)
+    global _idempotency_pruned_at
+    now = int(time.time())
+    with transaction() as connection:
+        cursor = connection.cursor()
+        if now - _idempotency_pruned_at > 60:
+            _idempotency_pruned_at = now
+            cursor.execute(
+                "DELETE FROM idempotency_keys WHERE created_at < ?", (now - ttl,)
+            )
+        cursor.execute(
+            """INSERT INTO idempotency_keys (key, fingerprint, state, created_at)
+            VALUES (?, ?, 'pending', ?)
+            ON CONFLICT(key) DO UPDATE
+            SET fingerprint = excluded.fingerprint, state = 'pending', status = NULL,
+            headers = NULL, body = NULL, created_at = excluded.created_at
+            WHERE created_at < ?""",
+            (key, fingerprint, now, now - ttl),
+        )
+        if cursor.rowcount:
+            return None
+        cursor.execute(
+            "SELECT fingerprint, state, status, headers, body FROM idempotency_keys WHERE key = ?",
+            (key,),
+        )
+        return cursor.fetchone()
+
+
+@metrics.timed("database")
+def complete_idempotency_key(key: str, status: int, headers: str, body: bytes):
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            """UPDATE idempotency_keys SET state = 'complete', status = ?, headers = ?, body = ?
+            WHERE key = ?""",
+            (status, headers, body, key),
+        )
+
+
+@metrics.timed("database")
+def release_idempotency_key(key: str):
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            "DELETE FROM idempotency_keys WHERE key = ? AND state = 'pending'", (key,)
+        )
 
 
 ####################
 # ADMINS
 ####################
+@metrics.timed("database")
 def get_admin_by_email(email: str) -> models.Admin | None:
-    with sqlite3.connect(db) as connection:
+    with transaction() as connection:
         cursor = connection.cursor()
         cursor.execute("SELECT * FROM admins WHERE email = ?", (email,))
         row = cursor.fetchone()
@@ -126,8 +917,9 @@ def get_admin_by_email(email: str) -> models.Admin | None:
 ####################
 
 
+@metrics.timed("database")
 def add_user(user: models.User) -> models.User:
-    with sqlite3.connect(db) as connection:
+    with transaction() as connection:
         cursor = connection.cursor()
         cursor.execute(
             """INSERT INTO users
@@ -135,12 +927,12 @@ def add_user(user: models.User) -> models.User:
             VALUES (?, ?)""",
             (user.email, user.password),
         )
-        connection.commit()
     return user
 
 
+@metrics.timed("database")
 def get_user_by_email(email: str) -> models.User | None:
-    with sqlite3.connect(db) as connection:
+    with transaction() as connection:
         cursor = connection.cursor()
         cursor.execute("SELECT * FROM users WHERE email = ?", (email,))
         row = cursor.fetchone()
@@ -158,20 +950,42 @@ def get_user_by_email(email: str) -> models.User | None:
             return None
 
 
+@metrics.timed("database")
 def change_user_pass(email: models.EmailStr, password: str):
-    with sqlite3.connect(db) as connection:
+    with transaction() as connection:
         cursor = connection.cursor()
         cursor.execute(
             "UPDATE users SET password = ? WHERE email = ?", (password, email)
         )
-        connection.commit()
 
 
+@metrics.timed("database")
 def delete_user(email: models.EmailStr):
-    with sqlite3.connect(db) as connection:
+    with transaction() as connection:
         cursor = connection.cursor()
         cursor.execute("DELETE FROM users WHERE email = ?", (email,))
-        connection.commit()
+
+
+@metrics.timed("database")
+def revoke_tokens(email: str, revoked_at: int):
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            """INSERT INTO token_revocations (email, revoked_at) VALUES (?, ?)
+            ON CONFLICT(email) DO UPDATE SET revoked_at = MAX(revoked_at, excluded.revoked_at)""",
+            (email, revoked_at),
+        )
+
+
+@metrics.timed("database")
+def get_token_revocations(since: int = 0) -> dict[str, int]:
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT email, revoked_at FROM token_revocations WHERE revoked_at >= ?",
+            (since,),
+        )
+        return dict(cursor.fetchall())
 
 
 ####################
@@ -179,169 +993,70 @@ def delete_user(email: models.EmailStr):
 ####################
 
 
+@metrics.timed("database")
 def add_delegate(delegate: models.Delegate) -> models.Delegate:
-    pastmuns = ""
-    for mun in delegate.pastmuns:
-        pastmuns += (
-            mun.name
-            + ","
-            + mun.committee
-            + ","
-            + mun.delegation
-            + ","
-            + str(mun.year)
-            + ","
-            + mun.award
-            + ";"
-        )
-    with sqlite3.connect(db) as connection:
+    with transaction() as connection:
         cursor = connection.cursor()
-        cursor.execute(
-            """INSERT INTO delegates
-                       (id, firstname, lastname, email, contact, dateofbirth, gender, pastmuns, verified)
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (
-                delegate.id,
-                delegate.firstname,
-                delegate.lastname,
-                delegate.email,
-                delegate.contact,
-                delegate.dateofbirth,
-                delegate.gender,
-                pastmuns,
-                delegate.verified,
-            ),
-        )
-        connection.commit()
+        cursor.execute(insert_delegate_sql, _delegate_params(delegate))
     return delegate
 
 
+@metrics.timed("database")
 def get_delegates() -> list[models.Delegate]:
-    with sqlite3.connect(db) as connection:
+    with transaction() as connection:
         cursor = connection.cursor()
         cursor.execute("SELECT * FROM delegates")
-        rows = cursor.fetchall()
-        delegates = []
-        for row in rows:
-            mun_list = []
-            if row[7] != "":
-                muns = row[7].split(";")
-                for mun in muns:
-                    m = mun.split(",")
-                    if m != [""]:
-                        mun_list.append(
-                            models.MunExperience(
-                                name=m[0],
-                                committee=m[1],
-                                delegation=m[2],
-                                year=int(m[3]),
-                                award=m[4],
-                            )
-                        )
-            delegate = models.Delegate(
-                id=row[0],
-                firstname=row[1],
-                lastname=row[2],
-                email=row[3],
-                contact=row[4],
-                dateofbirth=row[5],
-                gender=row[6],
-                pastmuns=mun_list,
-                verified=row[8],
-            )
-            delegates.append(delegate)
-        return delegates
+        return [_delegate_from_row(row) for row in cursor.fetchall()]
+
+
+@metrics.timed("database")
+def get_delegates_fields(fields: list[str], id: str | None = None) -> list[dict]:
+    with transaction() as connection:
+        return _select_fields(
+            connection.cursor(), "delegates", delegate_columns, fields, id
+        )
+
+
+@metrics.timed("database")
+def get_delegates_batch(ids: list[str], emails: list[str]) -> models.DelegateBatch:
+    with transaction() as connection:
+        rows, missing_ids, missing_emails = _batch_lookup(
+            connection.cursor(), "delegates", ids, emails
+        )
+    return models.DelegateBatch(
+        delegates=[_delegate_from_row(row) for row in rows],
+        missing_ids=missing_ids,
+        missing_emails=missing_emails,
+    )
 
 
+@metrics.timed("database")
 def get_delegate_by_id(id: str) -> models.Delegate | None:
-    with sqlite3.connect(db) as connection:
+    with transaction() as connection:
         cursor = connection.cursor()
         cursor.execute("SELECT * FROM delegates WHERE id = ?", (id,))
         row = cursor.fetchone()
         if row:
-            mun_list = []
-            if row[7] != "":
-                muns = row[7].split(";")
-                for mun in muns:
-                    m = mun.split(",")
-                    if m != [""]:
-                        mun_list.append(
-                            models.MunExperience(
-                                name=m[0],
-                                committee=m[1],
-                                delegation=m[2],
-                                year=int(m[3]),
-                                award=m[4],
-                            )
-                        )
-            return models.Delegate(
-                id=row[0],
-                firstname=row[1],
-                lastname=row[2],
-                email=row[3],
-                contact=row[4],
-                dateofbirth=row[5],
-                gender=row[6],
-                pastmuns=mun_list,
-                verified=row[8],
-            )
-        else:
-            return None
+            return _delegate_from_row(row)
+        return None
 
 
+@metrics.timed("database")
 def get_delegate_by_email(email: models.EmailStr) -> models.Delegate | None:
-    with sqlite3.connect(db) as connection:
+    with transaction() as connection:
         cursor = connection.cursor()
         cursor.execute("SELECT * FROM delegates WHERE email = ?", (email,))
         row = cursor.fetchone()
         if row:
-            mun_list = []
-            if row[7] != "":
-                muns = row[7].split(";")
-                for mun in muns:
-                    m = mun.split(",")
-                    if m != [""]:
-                        mun_list.append(
-                            models.MunExperience(
-                                name=m[0],
-                                committee=m[1],
-                                delegation=m[2],
-                                year=int(m[3]),
-                                award=m[4],
-                            )
-                        )
-            return models.Delegate(
-                id=row[0],
-                firstname=row[1],
-                lastname=row[2],
-                email=row[3],
-                contact=row[4],
-                dateofbirth=row[5],
-                gender=row[6],
-                pastmuns=mun_list,
-                verified=row[8],
-            )
-        else:
-            return None
+            return _delegate_from_row(row)
+        return None
 
 
+@metrics.timed("database")
 def update_delegate_by_id(id: str, delegate: models.Delegate) -> models.Delegate:
-    with sqlite3.connect(db) as connection:
+    with transaction() as connection:
         cursor = connection.cursor()
-        pastmuns = ""
-        for mun in delegate.pastmuns:
-            pastmuns += (
-                mun.name
-                + ","
-                + mun.committee
-                + ","
-                + mun.delegation
-                + ","
-                + str(mun.year)
-                + ","
-                + mun.award
-                + ";"
-            )
+        pastmuns = _pastmuns_to_str(delegate.pastmuns)
         cursor.execute(
             """UPDATE delegates
                        SET firstname = ?, lastname = ?, email = ?, contact = ?, dateofbirth = ?, gender = ?, pastmuns = ?, verified = ?
@@ -358,14 +1073,63 @@ def update_delegate_by_id(id: str, delegate: models.Delegate) -> models.Delegate
                 id,
             ),
         )
-        connection.commit()
         return delegate
 
 
-def verify_delegate_email(email: models.EmailStr):
-    with sqlite3.connect(db) as connection:
+@metrics.timed("database")
+def verify_delegate_email(email: models.EmailStr) -> bool:
+    with transaction() as connection:
         cursor = connection.cursor()
         cursor.execute("UPDATE delegates SET verified = 1 WHERE email = ?", (email,))
+        return cursor.rowcount > 0
+
+
+@metrics.timed("database")
+def patch_delegate(id: str, fields: dict) -> models.Delegate | None:
+    with transaction() as connection:
+        row = _patch_row(connection.cursor(), "delegates", delegate_columns, id, fields)
+    return _delegate_from_row(row) if row else None
+
+
+@metrics.timed("database")
+def get_delegate_ids_by_email(emails: list[str]) -> dict[str, str]:
+    ids = {}
+    with transaction() as connection:
+        cursor = connection.cursor()
+        for chunk in _chunks(list(emails)):
+            cursor.execute(
+                f"SELECT email, id FROM delegates WHERE email IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            ids.update(cursor.fetchall())
+    return ids
+
+
+@metrics.timed("database")
+def add_delegates(delegates: list[models.Delegate]) -> list[models.Delegate]:
+    # Delegates whose id or email already exists are skipped and returned
+    with transaction() as connection:
+        cursor = connection.cursor()
+        existing = set()
+        for chunk in _chunks(delegates):
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(
+                f"SELECT id, email FROM delegates WHERE id IN ({placeholders}) OR email IN ({placeholders})",
+                [d.id for d in chunk] + [d.email for d in chunk],
+            )
+            for id, email in cursor.fetchall():
+                existing.add(id)
+                existing.add(email)
+        skipped = [d for d in delegates if d.id in existing or d.email in existing]
+        cursor.executemany(
+            insert_delegate_sql,
+            (
+                _delegate_params(d)
+                for d in delegates
+                if d.id not in existing and d.email not in existing
+            ),
+        )
+    return skipped
 
 
 ####################
@@ -373,27 +1137,109 @@ def verify_delegate_email(email: models.EmailStr):
 ####################
 
 
+@metrics.timed("database")
 def add_mm_delegate(mm_delegate: models.MMDelegate) -> models.MMDelegate:
-    pastmuns = ""
-    for mun in mm_delegate.pastmuns:
-        pastmuns += (
-            mun.name
-            + ","
-            + mun.committee
-            + ","
-            + mun.delegation
-            + ","
-            + str(mun.year)
-            + ","
-            + mun.award
-            + ";"
-        )
-    with sqlite3.connect(mm_db) as connection:
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(insert_mm_delegate_sql, _mm_delegate_params(mm_delegate))
+        _scan_write(mm_delegate.id, _scan_entry_from_model(mm_delegate))
+    return mm_delegate
+
+
+@metrics.timed("database")
+def add_mm_delegates(
+    mm_delegates: list[models.MMDelegate],
+) -> list[models.MMDelegate]:
+    # MM delegates whose id or email is already registered are skipped and returned
+    with transaction() as connection:
+        cursor = connection.cursor()
+        existing = set()
+        for chunk in _chunks(mm_delegates):
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(
+                f"SELECT id, email FROM mm_delegates WHERE id IN ({placeholders}) OR email IN ({placeholders})",
+                [d.id for d in chunk] + [d.email for d in chunk],
+            )
+            for id, email in cursor.fetchall():
+                existing.add(id)
+                existing.add(email)
+        skipped = [d for d in mm_delegates if d.id in existing or d.email in existing]
+        cursor.executemany(
+            insert_mm_delegate_sql,
+            (
+                _mm_delegate_params(d)
+                for d in mm_delegates
+                if d.id not in existing and d.email not in existing
+            ),
+        )
+        for d in mm_delegates:
+            if d.id not in existing and d.email not in existing:
+                _scan_write(d.id, _scan_entry_from_model(d))
+    return skipped
+
+
+@metrics.timed("database")
+def get_mm_delegates() -> list[models.MMDelegate]:
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM mm_delegates")
+        return [_mm_delegate_from_row(row) for row in cursor.fetchall()]
+
+
+@metrics.timed("database")
+def get_mm_delegates_fields(fields: list[str], id: str | None = None) -> list[dict]:
+    with transaction() as connection:
+        return _select_fields(
+            connection.cursor(), "mm_delegates", mm_delegate_columns, fields, id
+        )
+
+
+@metrics.timed("database")
+def get_mm_delegates_batch(
+    ids: list[str], emails: list[str]
+) -> models.MMDelegateBatch:
+    with transaction() as connection:
+        rows, missing_ids, missing_emails = _batch_lookup(
+            connection.cursor(), "mm_delegates", ids, emails
+        )
+    return models.MMDelegateBatch(
+        delegates=[_mm_delegate_from_row(row) for row in rows],
+        missing_ids=missing_ids,
+        missing_emails=missing_emails,
+    )
+
+
+@metrics.timed("database")
+def get_mm_delegate_by_id(id: str) -> models.MMDelegate | None:
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM mm_delegates WHERE id = ?", (id,))
+        row = cursor.fetchone()
+        if row:
+            return _mm_delegate_from_row(row)
+        return None
+
+
+@metrics.timed("database")
+def get_mm_delegate_by_email(email: str) -> models.MMDelegate | None:
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute("SELECT * FROM mm_delegates WHERE email = ?", (email,))
+        row = cursor.fetchone()
+        if row:
+            return _mm_delegate_from_row(row)
+        return None
+
+
+@metrics.timed("database")
+def update_mm_delegate(id: str, mm_delegate: models.MMDelegate) -> models.MMDelegate:
+    with transaction() as connection:
+        pastmuns = _pastmuns_to_str(mm_delegate.pastmuns)
+
         cursor = connection.cursor()
         cursor.execute(
-            """INSERT INTO mm_delegates(id, firstname, lastname, email, contact, dateofbirth, gender, pastmuns, verified, country, committee, d1_bf, d1_lunch, d1_hitea, d2_bf, d2_lunch, d2_hitea, d3_bf, d3_lunch, d3_hitea) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            """UPDATE mm_delegates SET firstname = ?, lastname = ?, email = ?, contact = ?, dateofbirth = ?, gender = ?, pastmuns = ?, verified = ?, country = ?, committee = ?, d1_bf = ?, d1_lunch = ?, d1_hitea = ?, d2_bf = ?, d2_lunch = ?, d2_hitea = ?, d3_bf = ?, d3_lunch = ?, d3_hitea = ? WHERE id = ?""",
             (
-                mm_delegate.id,
                 mm_delegate.firstname,
                 mm_delegate.lastname,
                 mm_delegate.email,
@@ -413,208 +1259,401 @@ def add_mm_delegate(mm_delegate: models.MMDelegate) -> models.MMDelegate:
                 mm_delegate.d3_bf,
                 mm_delegate.d3_lunch,
                 mm_delegate.d3_hitea,
+                id,
             ),
         )
-        connection.commit()
+        if cursor.rowcount:
+            _scan_write(id, _scan_entry_from_model(mm_delegate))
     return mm_delegate
 
 
-def get_mm_delegates() -> list[models.MMDelegate]:
-    with sqlite3.connect(mm_db) as connection:
-        cursor = connection.cursor()
-        cursor.execute("SELECT * FROM mm_delegates")
-        rows = cursor.fetchall()
-        delegates = []
-        for row in rows:
-            mun_list = []
-            if row[7] != "":
-                muns = row[7].split(";")
-                for mun in muns:
-                    m = mun.split(",")
-                    if m != [""]:
-                        mun_list.append(
-                            models.MunExperience(
-                                name=m[0],
-                                committee=m[1],
-                                delegation=m[2],
-                                year=int(m[3]),
-                                award=m[4],
-                            )
-                        )
-            delegate = models.MMDelegate(
-                id=row[0],
-                firstname=row[1],
-                lastname=row[2],
-                email=row[3],
-                contact=row[4],
-                dateofbirth=row[5],
-                gender=row[6],
-                pastmuns=mun_list,
-                verified=row[8],
-                country=row[9],
-                committee=row[10],
-                d1_bf=bool(row[11]),
-                d1_lunch=bool(row[12]),
-                d1_hitea=bool(row[13]),
-                d2_bf=bool(row[14]),
-                d2_lunch=bool(row[15]),
-                d2_hitea=bool(row[16]),
-                d3_bf=bool(row[17]),
-                d3_lunch=bool(row[18]),
-                d3_hitea=bool(row[19]),
-            )
-            delegates.append(delegate)
-        return delegates
+@metrics.timed("database")
+def patch_mm_delegate(id: str, fields: dict) -> models.MMDelegate | None:
+    with transaction() as connection:
+        row = _patch_row(
+            connection.cursor(), "mm_delegates", mm_delegate_columns, id, fields
+        )
+        if not row:
+            return None
+        mm_delegate = _mm_delegate_from_row(row)
+        _scan_write(id, _scan_entry_from_model(mm_delegate))
+    return mm_delegate
 
 
-def get_mm_delegate_by_id(id: str) -> models.MMDelegate | None:
-    with sqlite3.connect(mm_db) as connection:
+@metrics.timed("database")
+def delete_mm_delegate(id: str):
+    with transaction() as connection:
         cursor = connection.cursor()
-        cursor.execute("SELECT * FROM mm_delegates WHERE id = ?", (id,))
-        row = cursor.fetchone()
-        if row:
-            mun_list = []
-            if row[7] != "":
-                muns = row[7].split(";")
-                for mun in muns:
-                    m = mun.split(",")
-                    if m != [""]:
-                        mun_list.append(
-                            models.MunExperience(
-                                name=m[0],
-                                committee=m[1],
-                                delegation=m[2],
-                                year=int(m[3]),
-                                award=m[4],
-                            )
-                        )
-            return models.MMDelegate(
-                id=row[0],
-                firstname=row[1],
-                lastname=row[2],
-                email=row[3],
-                contact=row[4],
-                dateofbirth=row[5],
-                gender=row[6],
-                pastmuns=mun_list,
-                verified=row[8],
-                country=row[9],
-                committee=row[10],
-                d1_bf=bool(row[11]),
-                d1_lunch=bool(row[12]),
-                d1_hitea=bool(row[13]),
-                d2_bf=bool(row[14]),
-                d2_lunch=bool(row[15]),
-                d2_hitea=bool(row[16]),
-                d3_bf=bool(row[17]),
-                d3_lunch=bool(row[18]),
-                d3_hitea=bool(row[19]),
+        cursor.execute("DELETE FROM mm_delegates WHERE id = ?", (id,))
+        _scan_write(id, None)
+
+
+####################
+# SCAN INDEX
+####################
+
+# Index entries keep the meal flags as one int, bit i is meal_columns[i]
+scan_columns = ("firstname", "lastname", "committee", *meal_columns)
+
+# (firstname, lastname, committee, meal bits)
+ScanEntry = tuple[str, str, str, int]
+
+
+def _scan_entry(row: tuple) -> ScanEntry:
+    meals = 0
+    for bit, value in enumerate(row[3:]):
+        if value:
+            meals |= 1 << bit
+    return (row[0] or "", row[1] or "", row[2] or "", meals)
+
+
+def _scan_entry_from_model(mm_delegate: models.MMDelegate) -> ScanEntry:
+    return _scan_entry(tuple(getattr(mm_delegate, column) for column in scan_columns))
+
+
+class ScanIndex:
+    # What the food scanners need of every MM delegate of one event, in
+    # memory. Writes made by this worker are applied while the write lock is
+    # held, so in commit order, and undone by a reload if they roll back.
+    # Other workers' commits bump the file change counter in the database
+    # header (what PRAGMA data_version watches in rollback journal mode),
+    # and are then read back from the change feed
+    def __init__(self, event: str):
+        self.event = event
+        self.entries: dict[str, ScanEntry] = {}
+        self.seq = 0
+        self.counter: bytes | None = None
+        self.fd: int | None = None
+        self.lock = threading.Lock()
+
+    def _counter(self) -> bytes:
+        if self.fd is None:
+            self.fd = os.open(event_db(self.event), os.O_RDONLY)
+        return os.pread(self.fd, 4, 24)
+
+    def load(self):
+        with self.lock, transaction() as connection:
+            # Read before the rows, a commit in between is replayed later
+            self.counter = self._counter()
+            cursor = connection.cursor()
+            cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM mm.changes")
+            self.seq = cursor.fetchone()[0]
+            cursor.execute(
+                f"SELECT id, {', '.join(scan_columns)} FROM mm.mm_delegates"
             )
+            self.entries = {row[0]: _scan_entry(row[1:]) for row in cursor}
+        logger.info(
+            "Loaded scan index",
+            extra={"event": self.event, "delegates": len(self.entries)},
+        )
+
+    def sync(self):
+        if self.counter is None:
+            self.load()
+            return
+        if self._counter() == self.counter:
+            return
+        with self.lock, transaction() as connection:
+            counter = self._counter()
+            if counter == self.counter:
+                return
+            self.counter = counter
+            cursor = connection.cursor()
+            cursor.execute(
+                f"""SELECT c.seq, c.key, d.id, {', '.join('d.' + c for c in scan_columns)}
+                FROM mm.changes c
+                LEFT JOIN mm.mm_delegates d ON c.op = 'upsert' AND d.id = c.key
+                WHERE c.seq > ? ORDER BY c.seq""",
+                (self.seq,),
+            )
+            for row in cursor:
+                self.seq = row[0]
+                if row[2] is None:
+                    self.entries.pop(row[1], None)
+                else:
+                    self.entries[row[1]] = _scan_entry(row[3:])
+
+    def get(self, id: str) -> ScanEntry | None:
+        self.sync()
+        return self.entries.get(id)
+
+    def write(self, id: str, entry: ScanEntry | None):
+        with self.lock:
+            if entry is None:
+                self.entries.pop(id, None)
+            else:
+                self.entries[id] = entry
+
+    def invalidate(self):
+        self.counter = None
+
+
+_scan_indexes: dict[str, ScanIndex] = {}
+_scan_indexes_lock = threading.Lock()
+
+
+def scan_index() -> ScanIndex:
+    event = current_event()
+    index = _scan_indexes.get(event)
+    if index is None:
+        with _scan_indexes_lock:
+            index = _scan_indexes.setdefault(event, ScanIndex(event))
+    return index
+
+
+def load_scan_index():
+    scan_index().sync()
+
+
+def _scan_write(id: str, entry: ScanEntry | None):
+    # Called inside the writing transaction, events whose index was never
+    # loaded have nothing to update
+    index = _scan_indexes.get(current_event())
+    if index is not None:
+        index.write(id, entry)
+        on_rollback(index.invalidate)
+
+
+@metrics.timed("scan_index")
+def get_scan_delegate(id: str) -> models.ScanDelegate | None:
+    entry = scan_index().get(id)
+    if entry is None:
         return None
+    firstname, lastname, committee, meals = entry
+    return models.ScanDelegate(
+        id=id,
+        firstname=firstname,
+        lastname=lastname,
+        committee=committee,
+        **{column: bool(meals >> bit & 1) for bit, column in enumerate(meal_columns)},
+    )
 
 
-def get_mm_delegate_by_email(email: str) -> models.MMDelegate | None:
-    with sqlite3.connect(mm_db) as connection:
+####################
+# CROSS DATABASE
+####################
+
+
+@metrics.timed("database")
+def get_registration(
+    email: str,
+) -> tuple[bool, models.Delegate | None, models.MMDelegate | None]:
+    # (has a user account, delegate profile, MM registration) in one query
+    with transaction() as connection:
         cursor = connection.cursor()
-        cursor.execute("SELECT * FROM mm_delegates WHERE email = ?", (email,))
+        cursor.execute(
+            """SELECT EXISTS (SELECT 1 FROM users WHERE email = q.email), d.*, m.*
+            FROM (SELECT ? AS email) AS q
+            LEFT JOIN delegates AS d ON d.email = q.email
+            LEFT JOIN mm.mm_delegates AS m ON m.email = q.email""",
+            (email,),
+        )
         row = cursor.fetchone()
-        if row:
-            mun_list = []
-            if row[7] != "":
-                muns = row[7].split(";")
-                for mun in muns:
-                    m = mun.split(",")
-                    if m != [""]:
-                        mun_list.append(
-                            models.MunExperience(
-                                name=m[0],
-                                committee=m[1],
-                                delegation=m[2],
-                                year=int(m[3]),
-                                award=m[4],
-                            )
-                        )
-            return models.MMDelegate(
-                id=row[0],
-                firstname=row[1],
-                lastname=row[2],
-                email=row[3],
-                contact=row[4],
-                dateofbirth=row[5],
-                gender=row[6],
-                pastmuns=mun_list,
-                verified=row[8],
-                country=row[9],
-                committee=row[10],
-                d1_bf=bool(row[11]),
-                d1_lunch=bool(row[12]),
-                d1_hitea=bool(row[13]),
-                d2_bf=bool(row[14]),
-                d2_lunch=bool(row[15]),
-                d2_hitea=bool(row[16]),
-                d3_bf=bool(row[17]),
-                d3_lunch=bool(row[18]),
-                d3_hitea=bool(row[19]),
-            )
-        return None
+        delegate = _delegate_from_row(row[1:10]) if row[1] is not None else None
+        mm_delegate = _mm_delegate_from_row(row[10:]) if row[10] is not None else None
+        return bool(row[0]), delegate, mm_delegate
 
 
-def update_mm_delegate(id: str, mm_delegate: models.MMDelegate) -> models.MMDelegate:
-    try:
-        with sqlite3.connect(mm_db) as connection:
-            pastmuns = ""
-            for mun in mm_delegate.pastmuns:
-                pastmuns += (
-                    mun.name
-                    + ","
-                    + mun.committee
-                    + ","
-                    + mun.delegation
-                    + ","
-                    + str(mun.year)
-                    + ","
-                    + mun.award
-                    + ";"
-                )
+@metrics.timed("database")
+def get_conference(
+    id: str,
+) -> tuple[models.Delegate | None, models.MMDelegate | None, tuple[int, int]]:
+    # Profile, MM registration and the versions of both tables in one query
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            """SELECT
+            (SELECT version FROM main.data_versions WHERE name = 'delegates'),
+            (SELECT version FROM mm.data_versions WHERE name = 'mm_delegates'),
+            d.*, m.*
+            FROM delegates AS d
+            LEFT JOIN mm.mm_delegates AS m ON m.id = d.id
+            WHERE d.id = ?""",
+            (id,),
+        )
+        row = cursor.fetchone()
+        if not row:
+            return None, None, (0, 0)
+        delegate = _delegate_from_row(row[2:11])
+        mm_delegate = _mm_delegate_from_row(row[11:]) if row[11] is not None else None
+        return delegate, mm_delegate, (row[0] or 0, row[1] or 0)
 
-            cursor = connection.cursor()
-            cursor.execute(
-                """UPDATE mm_delegates SET firstname = ?, lastname = ?, email = ?, contact = ?, dateofbirth = ?, gender = ?, pastmuns = ?, verified = ?, country = ?, committee = ?, d1_bf = ?, d1_lunch = ?, d1_hitea = ?, d2_bf = ?, d2_lunch = ?, d2_hitea = ?, d3_bf = ?, d3_lunch = ?, d3_hitea = ? WHERE id = ?""",
-                (
-                    mm_delegate.firstname,
-                    mm_delegate.lastname,
-                    mm_delegate.email,
-                    mm_delegate.contact,
-                    mm_delegate.dateofbirth,
-                    mm_delegate.gender,
-                    pastmuns,
-                    mm_delegate.verified,
-                    mm_delegate.country,
-                    mm_delegate.committee,
-                    mm_delegate.d1_bf,
-                    mm_delegate.d1_lunch,
-                    mm_delegate.d1_hitea,
-                    mm_delegate.d2_bf,
-                    mm_delegate.d2_lunch,
-                    mm_delegate.d2_hitea,
-                    mm_delegate.d3_bf,
-                    mm_delegate.d3_lunch,
-                    mm_delegate.d3_hitea,
-                    id,
-                ),
-            )
-            connection.commit()
-        return mm_delegate
-    except Exception as e:
-        print(e)
-        return mm_delegate
 
+@metrics.timed("database")
+def get_delegates_without_mm_registration() -> list[models.Delegate]:
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            """SELECT d.* FROM delegates AS d
+            WHERE NOT EXISTS (SELECT 1 FROM mm.mm_delegates AS m WHERE m.id = d.id)"""
+        )
+        return [_delegate_from_row(row) for row in cursor.fetchall()]
 
-def delete_mm_delegate(id: str):
-    with sqlite3.connect(mm_db) as connection:
+
+@metrics.timed("database")
+def get_mm_delegates_with_unverified_profile() -> list[models.MMDelegate]:
+    with transaction() as connection:
         cursor = connection.cursor()
-        cursor.execute("DELETE FROM mm_delegates WHERE id = ?", (id,))
-        connection.commit()
+        cursor.execute(
+            """SELECT m.* FROM mm.mm_delegates AS m
+            LEFT JOIN delegates AS d ON d.id = m.id
+            WHERE d.id IS NULL OR NOT d.verified"""
+        )
+        return [_mm_delegate_from_row(row) for row in cursor.fetchall()]
+
+
+####################
+# STATS
+####################
+
+# event -> (data versions, computed at, stats)
+_stats_cache: dict[str, tuple[tuple[int, int], float, models.Stats]] = {}
+
+
+def _delegate_stats() -> models.DelegateStats:
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT verified, gender, COUNT(*) FROM delegates GROUP BY verified, gender"
+        )
+        stats = models.DelegateStats()
+        for verified, gender, count in cursor.fetchall():
+            stats.total += count
+            if verified:
+                stats.verified += count
+            gender = gender or "unspecified"
+            stats.gender[gender] = stats.gender.get(gender, 0) + count
+        stats.unverified = stats.total - stats.verified
+        return stats
+
+
+def _mm_delegate_stats() -> models.MMDelegateStats:
+    with transaction() as connection:
+        cursor = connection.cursor()
+        stats = models.MMDelegateStats()
+        cursor.execute(
+            f"SELECT COUNT(*), TOTAL(verified), {', '.join(f'TOTAL({c})' for c in meal_columns)} FROM mm_delegates"
+        )
+        row = cursor.fetchone()
+        stats.total = row[0]
+        stats.verified = int(row[1])
+        stats.unverified = stats.total - stats.verified
+        stats.meals = {c: int(v) for c, v in zip(meal_columns, row[2:])}
+
+        cursor.execute(
+            "SELECT committee, country, COUNT(*) FROM mm_delegates GROUP BY committee, country"
+        )
+        for committee, country, count in cursor.fetchall():
+            committee = committee or "unassigned"
+            country = country or "unassigned"
+            stats.committee[committee] = stats.committee.get(committee, 0) + count
+            stats.country[country] = stats.country.get(country, 0) + count
+
+        cursor.execute("SELECT gender, COUNT(*) FROM mm_delegates GROUP BY gender")
+        for gender, count in cursor.fetchall():
+            gender = gender or "unspecified"
+            stats.gender[gender] = stats.gender.get(gender, 0) + count
+
+        cursor.execute(
+            "SELECT date(registered_at), COUNT(*) FROM mm_delegates GROUP BY date(registered_at)"
+        )
+        for day, count in cursor.fetchall():
+            stats.registrations_per_day[day or "unknown"] = count
+        return stats
+
+
+@metrics.timed("database")
+def get_stats(max_age: int = 0) -> models.Stats:
+    # Cached per worker and recomputed only after a write bumped the data
+    # versions. With max_age, a cached result is served without even checking
+    # the versions until it is that many seconds old
+    event = current_event()
+    cached = _stats_cache.get(event)
+    now = time.time()
+    if cached and now - cached[1] < max_age:
+        return cached[2]
+    with transaction():
+        versions = (
+            get_data_version("delegates")[0],
+            get_data_version("mm_delegates")[0],
+        )
+        if cached and cached[0] == versions:
+            _stats_cache[event] = (versions, now, cached[2])
+            return cached[2]
+        stats = models.Stats(
+            delegates=_delegate_stats(),
+            mumbaimun=_mm_delegate_stats(),
+            generated_at=datetime.fromtimestamp(now, timezone.utc),
+        )
+    _stats_cache[event] = (versions, now, stats)
+    return stats
+
+
+def invalidate_stats():
+    _stats_cache.clear()
+
+
+####################
+# SEARCH
+####################
+
+
+# Shorter terms are dropped, the prefix='2 3' index starts at 2 characters
+# and a single letter matches most of the table
+search_min_term = 2
+
+# Ranking costs time per match, so a broad query ranks only its newest this
+# many matches
+search_rank_limit = 1000
+
+
+def _match_query(query: str) -> str:
+    # Every word is quoted so user input can't inject FTS5 syntax, and
+    # matched as a prefix so partial names and emails still hit
+    terms = [
+        term.replace('"', '""')
+        for term in query.split()
+        if len(term) >= search_min_term
+    ]
+    return " ".join(f'"{term}"*' for term in terms)
+
+
+@metrics.timed("database")
+def search_delegates(query: str, limit: int = 20) -> list[models.Delegate]:
+    match = _match_query(query)
+    if not match:
+        return []
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            """SELECT delegates.* FROM delegates_fts
+            JOIN delegates ON delegates.rowid = delegates_fts.rowid
+            WHERE delegates_fts MATCH ?1 AND delegates_fts.rowid >= IFNULL(
+                (SELECT rowid FROM delegates_fts WHERE delegates_fts MATCH ?1
+                ORDER BY rowid DESC LIMIT 1 OFFSET ?2), 0)
+            ORDER BY rank LIMIT ?3""",
+            (match, search_rank_limit - 1, limit),
+        )
+        return [_delegate_from_row(row) for row in cursor.fetchall()]
+
+
+@metrics.timed("database")
+def search_mm_delegates(query: str, limit: int = 20) -> list[models.MMDelegate]:
+    match = _match_query(query)
+    if not match:
+        return []
+    with transaction() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            """SELECT mm_delegates.* FROM mm_delegates_fts
+            JOIN mm_delegates ON mm_delegates.rowid = mm_delegates_fts.rowid
+            WHERE mm_delegates_fts MATCH ?1 AND mm_delegates_fts.rowid >= IFNULL(
+                (SELECT rowid FROM mm_delegates_fts WHERE mm_delegates_fts MATCH ?1
+                ORDER BY rowid DESC LIMIT 1 OFFSET ?2), 0)
+            ORDER BY rank LIMIT ?3""",
+            (match, search_rank_limit - 1, limit),
+        )
+        return [_mm_delegate_from_row(row) for row in cursor.fetchall()]
 
 
 ####################
@@ -622,6 +1661,7 @@ def delete_mm_delegate(id: str):
 ####################
 
 
+@metrics.timed("database")
 def backup_database():
     with sqlite3.connect(db) as connection:
         with sqlite3.connect(backup_db) as b_conn:
@@ -631,8 +1671,25 @@ def backup_database():
         with sqlite3.connect(mm_backup_db) as mm_b_conn:
             mm_connection.backup(mm_b_conn)
 
+    event_backups = []
+    for event in get_events():
+        if event.slug == legacy_event or not os.path.exists(event_db(event.slug)):
+            continue
+        event_backup = os.path.join(
+            os.path.dirname(backup_db), f"{event.slug}_backup.db"
+        )
+        with sqlite3.connect(event_db(event.slug)) as event_connection:
+            with sqlite3.connect(event_backup) as event_b_conn:
+                event_connection.backup(event_b_conn)
+        event_backups.append(event_backup)
+
     with zipfile.ZipFile(db_zip, "w") as z:
         z.write(backup_db, arcname=os.path.basename(backup_db))
         z.write(mm_backup_db, arcname=os.path.basename(mm_backup_db))
+        for event_backup in event_backups:
+            z.write(
+                event_backup,
+                arcname=os.path.join("events", os.path.basename(event_backup)),
+            )
 
-    print("Both main and mm databases backed up and compressed successfully")
+    logger.info("Main, mm and event databases backed up and compressed successfully")
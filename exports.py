@@ -0,0 +1,183 @@
+import csv
+import glob
+import gzip
+import logging
+import os
+import tempfile
+import time
+from io import StringIO
+from typing import Callable
+
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Exports are written once per data version as exports/<name>-<version>,
+# with .gz (and .br when brotli is installed) variants next to them, so a
+# repeat download is a file send
+exports_folder = os.path.join(os.path.dirname(__file__), "exports")
+
+logger = logging.getLogger("mundra.exports")
+
+# Content-Encoding -> file suffix, in order of preference
+encodings = {"br": ".br", "gzip": ".gz"} if brotli else {"gzip": ".gz"}
+
+# A superseded version can still be on its way to a FileResponse, so it is
+# only removed once the version after it has existed for this long
+superseded_grace_seconds = 60
+
+csv_columns = [
+    "id",
+    "firstname",
+    "lastname",
+    "email",
+    "contact",
+    "dateofbirth",
+    "gender",
+    "pastmuns",
+]
+
+
+def to_csv(delegates: list) -> str:
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(csv_columns)
+    for delegate in delegates:
+        past_muns_info = []
+        for mun in delegate.pastmuns:
+            past_muns_info.append(
+                f"{mun.name} | {mun.committee} | {mun.delegation} | {mun.year} | {mun.award}"
+            )
+        writer.writerow(
+            [
+                delegate.id,
+                delegate.firstname,
+                delegate.lastname,
+                delegate.email,
+                delegate.contact,
+                delegate.dateofbirth,
+                delegate.gender,
+                " ; ".join(past_muns_info),
+            ]
+        )
+    return output.getvalue()
+
+
+def rows_to_csv(rows: list[dict], columns: list[str]) -> str:
+    # Sparse fieldset rows, pastmuns formatted the same way as to_csv
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(columns)
+    for row in rows:
+        if "pastmuns" in row:
+            row = row | {
+                "pastmuns": " ; ".join(
+                    f"{mun['name']} | {mun['committee']} | {mun['delegation']} | {mun['year']} | {mun['award']}"
+                    for mun in row["pastmuns"]
+                )
+            }
+        writer.writerow([row[column] for column in columns])
+    return output.getvalue()
+
+
+def _compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=6)
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
+def _write(path: str, data: bytes):
+    # A tmp file per call, threads of one worker can build the same version
+    fd, tmp = tempfile.mkstemp(
+        dir=exports_folder, prefix=os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _remove_superseded(name: str, current: str):
+    # Versions ordered by mtime, each one was superseded when the next was
+    # written
+    versions = []
+    for path in glob.glob(os.path.join(exports_folder, f"{name}-*")):
+        if path.endswith((".tmp", ".gz", ".br")):
+            continue
+        try:
+            versions.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            pass
+    versions.sort()
+    now = time.time()
+    for (_, old), (superseded_at, _) in zip(versions, versions[1:]):
+        if old == current or now - superseded_at < superseded_grace_seconds:
+            continue
+        for suffix in ("", ".gz", ".br"):
+            try:
+                os.remove(old + suffix)
+            except FileNotFoundError:
+                pass
+
+
+@metrics.timed("export")
+def build(name: str, version: str, content: bytes) -> str:
+    # The plain file is written last, its presence means the variants exist
+    os.makedirs(exports_folder, exist_ok=True)
+    path = os.path.join(exports_folder, f"{name}-{version}")
+    for encoding, suffix in encodings.items():
+        _write(path + suffix, _compress(content, encoding))
+    _write(path, content)
+    _remove_superseded(name, path)
+    logger.info("Built export %s-%s", name, version, extra={"bytes": len(content)})
+    return path
+
+
+def get(name: str, version: str) -> str | None:
+    path = os.path.join(exports_folder, f"{name}-{version}")
+    return path if os.path.exists(path) else None
+
+
+def get_or_build(
+    name: str, version: Callable[[], str], load: Callable[[], bytes | None]
+) -> tuple[str | None, bytes | None]:
+    # Returns (path, None) for a stored artifact. If the data changed while it
+    # was being read the content is returned unstored, as (None, content)
+    before = version()
+    path = get(name, before)
+    if path:
+        return path, None
+    content = load()
+    if content is None:
+        return None, None
+    if version() != before:
+        return None, content
+    return build(name, before, content), None
+
+
+def negotiate(path: str, accept_encoding: str) -> tuple[str, str | None]:
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    for encoding, suffix in encodings.items():
+        if encoding in accepted or "*" in accepted:
+            if os.path.exists(path + suffix):
+                return path + suffix, encoding
+    return path, None
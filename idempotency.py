@@ -0,0 +1,192 @@
+import hashlib
+import json
+import logging
+import re
+
+import anyio
+from starlette.concurrency import run_in_threadpool
+
+import config
+import database
+import metrics
+
+settings = config.get_settings()
+
+logger = logging.getLogger("mundra.idempotency")
+
+# POSTs that clients retry on flaky networks, a retry carrying the same
+# Idempotency-Key gets the stored response instead of running again
+idempotent_paths = re.compile(
+    r"^/(register|food|mumbaimun/register|events/[^/]+/register)$"
+)
+
+# Larger responses are not stored, the key is released instead
+max_stored_body = 64 * 1024
+
+# Responses a client is expected to retry, like server errors they release
+# the key instead of being replayed
+retryable_statuses = {408, 409, 425, 429}
+
+idempotent_requests = metrics.Counter(
+    "mundra_idempotent_requests_total",
+    "Requests carrying an Idempotency-Key by outcome",
+    ("route", "outcome"),
+)
+
+
+def _json_error(status: int, detail: str, headers: list | None = None) -> dict:
+    body = json.dumps({"detail": detail}).encode()
+    return {
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            *(headers or []),
+        ],
+        "body": body,
+    }
+
+
+class IdempotencyMiddleware:
+    # Plain ASGI middleware, it has to buffer the request body to fingerprint
+    # it and capture the response to store it
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not idempotent_paths.match(scope["path"])
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        key = ""
+        for name, value in scope["headers"]:
+            if name == b"idempotency-key":
+                key = value.decode("latin-1").strip()
+                break
+        if not key:
+            await self.app(scope, receive, send)
+            return
+        if len(key) > 255:
+            await self._send(send, _json_error(400, "Idempotency-Key is too long"))
+            return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        fingerprint = hashlib.sha256(
+            b"\0".join([scope["path"].encode(), scope["query_string"], body])
+        ).hexdigest()
+        stored = await run_in_threadpool(
+            database.claim_idempotency_key,
+            key,
+            fingerprint,
+            settings.idempotency_ttl_seconds,
+        )
+        if stored is not None:
+            await self._replay(send, scope["path"], fingerprint, stored)
+            return
+        idempotent_requests.inc(scope["path"], "new")
+
+        sent_body = False
+
+        async def replay_receive():
+            nonlocal sent_body
+            if sent_body:
+                return await receive()
+            sent_body = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        response = {"status": 500, "headers": [], "body": b""}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = list(message.get("headers", []))
+            elif message["type"] == "http.response.body":
+                response["body"] += message.get("body", b"")
+            await send(message)
+
+        try:
+            await self.app(scope, replay_receive, send_wrapper)
+        except BaseException:
+            # Shielded, a cancelled request still has to release its key
+            with anyio.CancelScope(shield=True):
+                await run_in_threadpool(database.release_idempotency_key, key)
+            raise
+        if (
+            response["status"] >= 500
+            or response["status"] in retryable_statuses
+            or len(response["body"]) > max_stored_body
+        ):
+            await run_in_threadpool(database.release_idempotency_key, key)
+            return
+        headers = [
+            (name.decode("latin-1"), value.decode("latin-1"))
+            for name, value in response["headers"]
+        ]
+        await run_in_threadpool(
+            database.complete_idempotency_key,
+            key,
+            response["status"],
+            json.dumps(headers),
+            response["body"],
+        )
+
+    async def _replay(self, send, path: str, fingerprint: str, stored: tuple):
+        stored_fingerprint, state, status, headers, body = stored
+        if stored_fingerprint != fingerprint:
+            idempotent_requests.inc(path, "mismatch")
+            await self._send(
+                send,
+                _json_error(
+                    422, "Idempotency-Key was already used for a different request"
+                ),
+            )
+            return
+        if state == "pending":
+            idempotent_requests.inc(path, "in_progress")
+            await self._send(
+                send,
+                _json_error(
+                    409,
+                    "A request with this Idempotency-Key is still in progress",
+                    [(b"retry-after", b"1")],
+                ),
+            )
+            return
+        idempotent_requests.inc(path, "replayed")
+        logger.info("Replayed idempotent response", extra={"path": path})
+        await self._send(
+            send,
+            {
+                "status": status,
+                "headers": [
+                    *(
+                        (name.encode("latin-1"), value.encode("latin-1"))
+                        for name, value in json.loads(headers)
+                    ),
+                    (b"idempotency-replayed", b"true"),
+                ],
+                "body": body,
+            },
+        )
+
+    async def _send(self, send, response: dict):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response["status"],
+                "headers": response["headers"],
+            }
+        )
+        await send({"type": "http.response.body", "body": response["body"]})
@@ -0,0 +1,99 @@
+import atexit
+import copy
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import logging
+import logging.handlers
+import queue
+import re
+import sys
+import uuid
+
+import orjson
+
+request_id: ContextVar[str] = ContextVar("request_id", default="-")
+
+_valid_request_id = re.compile(r"^[A-Za-z0-9._-]{1,128}$")
+
+# Attributes every LogRecord has, anything else was passed through extra=
+_record_attributes = set(vars(logging.makeLogRecord({}))) | {"message", "request_id"}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", "-"),
+        }
+        for key, value in vars(record).items():
+            if key not in _record_attributes:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    # The stock prepare() formats the message on the calling thread, this only
+    # captures the request id, formatting and I/O happen on the listener thread
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.request_id = request_id.get()
+        return record
+
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+def setup_logging(level: str = "INFO"):
+    global _listener
+    if _listener is not None:
+        return
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONFormatter())
+    _listener = logging.handlers.QueueListener(
+        log_queue, output, respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger()
+    root.handlers = [ContextQueueHandler(log_queue)]
+    root.setLevel(level)
+
+
+class RequestIdMiddleware:
+    # Reuses a well formed X-Request-ID from the client or a proxy, otherwise
+    # generates one, and echoes it on the response
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = ""
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                incoming = value.decode("latin-1")
+                break
+        rid = incoming if _valid_request_id.match(incoming) else uuid.uuid4().hex
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"x-request-id", rid.encode("latin-1")),
+                ]
+            await send(message)
+
+        token = request_id.set(rid)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id.reset(token)
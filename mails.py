@@ -1,16 +1,19 @@
+import logging
 import os
 from pathlib import Path
 from fastapi_mail import FastMail, MessageSchema, ConnectionConfig, MessageType
 from auth import create_verification_token, generate_password, hash_password, VERIFICATION_TOKEN_EXPIRE_MINUTES
-import config,database, models
+import assets, config,database, metrics, models
 
 settings = config.get_settings()
 
+logger = logging.getLogger("mundra.mails")
+
 template_dir = os.path.join(os.path.dirname(__file__), "email_templates") 
 url = settings.url
 tech_email = settings.tech_email
 support_email = settings.support_email
-logo_url = url + "/static/logo.jpg"
+logo_url = url + assets.asset_url("logo.jpg")
 
 conf = ConnectionConfig(
     MAIL_USERNAME=settings.mail_username,
@@ -26,6 +29,7 @@ conf = ConnectionConfig(
     TEMPLATE_FOLDER=Path(template_dir),
 )
 
+@metrics.timed("mail")
 async def send_verification_email(delegate: models.Delegate) -> None:
 
     token = create_verification_token(data={"sub": delegate.email})
@@ -40,7 +44,9 @@ async def send_verification_email(delegate: models.Delegate) -> None:
     )
     fm = FastMail(conf)
     await fm.send_message(message, template_name="email_verification.html")
+    logger.info("Sent verification email", extra={"delegate_id": delegate.id})
 
+@metrics.timed("mail")
 async def send_password_reset_email(delegate: models.Delegate, link: str) -> None:
 
     message = MessageSchema(
@@ -51,3 +57,4 @@ async def send_password_reset_email(delegate: models.Delegate, link: str) -> Non
     )
     fm = FastMail(conf)
     await fm.send_message(message, template_name="password_reset.html")
+    logger.info("Sent password reset email", extra={"delegate_id": delegate.id})
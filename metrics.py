@@ -0,0 +1,332 @@
+import asyncio
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+import json
+import os
+import threading
+import time
+
+import tracing
+
+# Every worker keeps its own registry in memory and periodically writes a
+# snapshot to metrics/<pid>.json, /metrics then sums the snapshots of all
+# live workers so any worker can answer a scrape.
+metrics_folder = os.path.join(os.path.dirname(__file__), "metrics")
+flush_interval = 5.0
+
+default_buckets = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+_lock = threading.Lock()
+_registry: dict[str, "Counter | Gauge | Histogram"] = {}
+_flusher: threading.Thread | None = None
+
+
+class RequestContext:
+    # Per request state shared with the threadpool, where sync endpoints run
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.queries = 0
+
+    @property
+    def route(self) -> str:
+        route = self.scope.get("route")
+        return route.path if route else "unmatched"
+
+
+current_request: ContextVar[RequestContext | None] = ContextVar(
+    "current_request", default=None
+)
+
+
+def current_route() -> str:
+    context = current_request.get()
+    return context.route if context else "background"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+        _registry[name] = self
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with _lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def snapshot(self) -> dict[str, float]:
+        return {json.dumps(k): v for k, v in self.values.items()}
+
+
+class Gauge(Counter):
+    # Summed across workers like a counter, so only suited to values such as
+    # in-flight requests where the total is meaningful
+    type = "gauge"
+
+    def set(self, value: float, *label_values: str):
+        with _lock:
+            self.values[label_values] = value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = default_buckets,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> per bucket counts (last one is +Inf), then sum
+        self.values: dict[tuple[str, ...], list[float]] = {}
+        _registry[name] = self
+
+    def observe(self, value: float, *label_values: str):
+        with _lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def snapshot(self) -> dict[str, list[float]]:
+        return {json.dumps(k): list(v) for k, v in self.values.items()}
+
+
+http_requests = Counter(
+    "mundra_http_requests_total",
+    "HTTP requests by route and status",
+    ("method", "route", "status"),
+)
+http_duration = Histogram(
+    "mundra_http_request_duration_seconds",
+    "HTTP request latency by route",
+    ("method", "route"),
+)
+operation_duration = Histogram(
+    "mundra_operation_duration_seconds",
+    "Latency of database, hashing, mail and QR calls",
+    ("subsystem", "operation"),
+)
+queries_per_request = Histogram(
+    "mundra_sql_queries_per_request",
+    "SQL statements issued by one request",
+    ("route",),
+    (0, 1, 2, 3, 5, 8, 13, 21, 50, 100),
+)
+operation_errors = Counter(
+    "mundra_operation_errors_total",
+    "Database, hashing, mail and QR calls that raised",
+    ("subsystem", "operation"),
+)
+
+
+def timed(subsystem: str):
+    def decorator(func):
+        operation = func.__name__
+        # Also recorded as a span when the request is traced
+        span_name = f"{subsystem}.{operation}"
+
+        if asyncio.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                span = tracing.start_span(span_name)
+                error = False
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    error = True
+                    operation_errors.inc(subsystem, operation)
+                    raise
+                finally:
+                    elapsed = time.perf_counter() - start
+                    operation_duration.observe(elapsed, subsystem, operation)
+                    if span:
+                        tracing.end_span(span, elapsed, error)
+
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            span = tracing.start_span(span_name)
+            error = False
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                error = True
+                operation_errors.inc(subsystem, operation)
+                raise
+            finally:
+                elapsed = time.perf_counter() - start
+                operation_duration.observe(elapsed, subsystem, operation)
+                if span:
+                    tracing.end_span(span, elapsed, error)
+
+        return wrapper
+
+    return decorator
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware, BaseHTTPMiddleware would add a task and a
+    # memory stream to every request
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = "500"
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        context = RequestContext(scope)
+        token = current_request.set(context)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request.reset(token)
+            path = context.route
+            http_requests.inc(scope["method"], path, status)
+            http_duration.observe(time.perf_counter() - start, scope["method"], path)
+            queries_per_request.observe(context.queries, path)
+            if _flusher is None:
+                start_flusher()
+
+
+def _flush_forever():
+    while True:
+        time.sleep(flush_interval)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+def start_flusher():
+    # Snapshots are written from a daemon thread so requests never wait on
+    # file I/O, started by the first request so it runs in the worker process
+    global _flusher
+    with _lock:
+        if _flusher is not None:
+            return
+        _flusher = threading.Thread(
+            target=_flush_forever, name="metrics-flush", daemon=True
+        )
+    _flusher.start()
+
+
+def flush():
+    with _lock:
+        snapshot = {name: metric.snapshot() for name, metric in _registry.items()}
+    path = os.path.join(metrics_folder, f"{os.getpid()}.json")
+    os.makedirs(metrics_folder, exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(path + ".tmp", path)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect() -> dict[str, dict]:
+    flush()
+    merged: dict[str, dict] = {}
+    for file in os.listdir(metrics_folder):
+        if not file.endswith(".json"):
+            continue
+        path = os.path.join(metrics_folder, file)
+        if not _pid_alive(int(file.removesuffix(".json"))):
+            os.remove(path)
+            continue
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, values in snapshot.items():
+            totals = merged.setdefault(name, {})
+            for key, value in values.items():
+                if isinstance(value, list):
+                    current = totals.setdefault(key, [0] * len(value))
+                    for i, v in enumerate(value):
+                        current[i] += v
+                else:
+                    totals[key] = totals.get(key, 0) + value
+    return merged
+
+
+def _labels(names: tuple[str, ...], values: list[str], extra: str = "") -> str:
+    pairs = [
+        n + '="' + v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for n, v in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def render() -> str:
+    # Prometheus text exposition format 0.0.4
+    merged = collect()
+    lines = []
+    for name, metric in _registry.items():
+        lines.append(f"# HELP {name} {metric.help}")
+        lines.append(f"# TYPE {name} {metric.type}")
+        for key, value in sorted(merged.get(name, {}).items()):
+            label_values = json.loads(key)
+            if metric.type != "histogram":
+                lines.append(f"{name}{_labels(metric.labels, label_values)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(
+                [*(str(b) for b in metric.buckets), "+Inf"], value[:-1]
+            ):
+                cumulative += count
+                labels = _labels(metric.labels, label_values, f'le="{bound}"')
+                lines.append(f"{name}_bucket{labels} {cumulative}")
+            labels = _labels(metric.labels, label_values)
+            lines.append(f"{name}_sum{labels} {value[-1]}")
+            lines.append(f"{name}_count{labels} {cumulative}")
+    return "\n".join(lines) + "\n"
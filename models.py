@@ -1,9 +1,26 @@
+from datetime import datetime
+import re
+
 from pydantic import BaseModel, EmailStr, field_validator
 
 
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str = ""
+    expires_in: int = 0
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+
+# Caller identity read from the access token claims
+class Principal(BaseModel):
+    email: str
+    role: str
+    id: str = ""
+    verified: bool = False
 
 
 class ErrorResponse(BaseModel):
@@ -66,3 +83,171 @@ class MMDelegate(Delegate):
     d3_bf: bool = False
     d3_lunch: bool = False
     d3_hitea: bool = False
+
+
+class ScanDelegate(BaseModel):
+    # What the food page shows, served from the in-memory scan index
+    id: str
+    firstname: str = ""
+    lastname: str = ""
+    committee: str = ""
+    d1_bf: bool = True
+    d1_lunch: bool = False
+    d1_hitea: bool = False
+    d2_bf: bool = False
+    d2_lunch: bool = False
+    d2_hitea: bool = False
+    d3_bf: bool = False
+    d3_lunch: bool = False
+    d3_hitea: bool = False
+
+
+# PROFILING
+
+
+class ProfileAllocation(BaseModel):
+    file: str
+    line: int
+    size_diff: int
+    count_diff: int
+
+
+class Profile(BaseModel):
+    id: str
+    method: str
+    path: str
+    query: str = ""
+    status: int
+    started_at: float
+    duration_ms: float
+    interval_ms: int
+    mode: str = "cpu"
+    samples: int
+    traced_peak_bytes: int = 0
+    allocations: list[ProfileAllocation] = []
+
+
+# BATCH LOOKUP
+
+
+class BatchRequest(BaseModel):
+    ids: list[str] = []
+    emails: list[str] = []
+
+
+class DelegateBatch(BaseModel):
+    # Matches for the ids then the emails in request order, each delegate once
+    delegates: list[Delegate]
+    missing_ids: list[str] = []
+    missing_emails: list[str] = []
+
+
+class MMDelegateBatch(DelegateBatch):
+    delegates: list[MMDelegate]
+
+
+# BULK IMPORT
+
+
+class ImportRowError(BaseModel):
+    row: int
+    error: str
+
+
+class ImportResult(BaseModel):
+    inserted: int
+    errors: list[ImportRowError] = []
+
+
+# STATS
+
+
+class DelegateStats(BaseModel):
+    total: int = 0
+    verified: int = 0
+    unverified: int = 0
+    gender: dict[str, int] = {}
+
+
+class MMDelegateStats(DelegateStats):
+    committee: dict[str, int] = {}
+    country: dict[str, int] = {}
+    registrations_per_day: dict[str, int] = {}
+    meals: dict[str, int] = {}
+
+
+class Stats(BaseModel):
+    delegates: DelegateStats
+    mumbaimun: MMDelegateStats
+    generated_at: datetime
+
+
+# QUERY PROFILING
+
+
+class QueryStats(BaseModel):
+    statement: str
+    calls: int
+    total_ms: float
+    mean_ms: float
+    rows: int
+    routes: dict[str, int]
+
+
+# EVENTS
+
+
+class Event(BaseModel):
+    slug: str
+    name: str
+
+    @field_validator("slug")
+    def validate_slug(cls, v):
+        # Also the shard's file name
+        if not re.fullmatch(r"[a-z0-9][a-z0-9-]{0,63}", v):
+            raise ValueError(
+                "Slug must be lowercase letters, digits and dashes, up to 64 characters"
+            )
+        return v
+
+
+# DELEGO APP
+
+
+class QRBadge(BaseModel):
+    # payload is what the QR code encodes, apps can render it themselves
+    payload: str
+    url: str
+    image: str = ""
+
+
+class QRVerification(BaseModel):
+    valid: bool
+    id: str = ""
+    event: str = ""
+
+
+class Conference(BaseModel):
+    profile: Delegate
+    mumbaimun: MMDelegate | None = None
+    qr: QRBadge
+
+
+# CHANGE FEED
+
+
+class Change(BaseModel):
+    seq: int
+    table: str
+    op: str
+    key: str
+    changed_at: int
+    # Current row for upserts of delegates and mm_delegates, None for deletes
+    # and for users, whose rows hold password hashes
+    data: MMDelegate | Delegate | None = None
+
+
+class ChangePage(BaseModel):
+    changes: list[Change]
+    next: int
+    more: bool
@@ -0,0 +1,308 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from urllib.parse import parse_qsl, urlencode
+import uuid
+
+from fastapi import HTTPException
+
+import auth
+import config
+
+settings = config.get_settings()
+
+# Profiled requests leave profiles/<id>.folded, collapsed stacks that
+# flamegraph.pl, speedscope and inferno read as is, and profiles/<id>.json
+# with the request, timings and the top allocations
+profiles_folder = os.path.join(os.path.dirname(__file__), "profiles")
+project_folder = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger("mundra.profiling")
+
+valid_profile_id = re.compile(r"^\d{8}T\d{6}-[0-9a-f]{8}$")
+
+# Allocation sites listed in a profile
+top_allocations = 25
+
+# Query parameters whose values never reach a saved profile
+secret_params = {
+    "token",
+    "access_token",
+    "refresh_token",
+    "id_token",
+    "password",
+    "new_password",
+    "secret",
+    "api_key",
+    "key",
+    "code",
+}
+
+
+class Sampler(threading.Thread):
+    # Walks the stack of every thread each interval. Threads are not tied to
+    # requests, so only stacks going through this project's code are kept,
+    # which drops idle threadpool workers and the idle event loop but not
+    # other requests running at the same time
+    def __init__(self, interval: float):
+        super().__init__(name="profiler", daemon=True)
+        self.interval = interval
+        self.stacks: dict[str, int] = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                in_project = False
+                while frame is not None:
+                    code = frame.f_code
+                    if (
+                        code.co_filename.startswith(project_folder)
+                        and "site-packages" not in code.co_filename
+                    ):
+                        in_project = True
+                    stack.append(
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                    frame = frame.f_back
+                if not in_project:
+                    continue
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_started_tracing = False
+
+
+def _start_tracing():
+    # tracemalloc slows allocation heavy requests down several times, so it
+    # only runs while a profile asks for it, and records one frame per
+    # allocation, all the per line statistics need
+    global _tracing_users, _started_tracing
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(1)
+            _started_tracing = True
+        _tracing_users += 1
+
+
+def _stop_tracing():
+    global _tracing_users, _started_tracing
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0 and _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+def _allocations(
+    before: tracemalloc.Snapshot, after: tracemalloc.Snapshot
+) -> list[dict]:
+    ignore = (
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    )
+    stats = after.filter_traces(ignore).compare_to(
+        before.filter_traces(ignore), "lineno"
+    )
+    return [
+        {
+            "file": stat.traceback[0].filename,
+            "line": stat.traceback[0].lineno,
+            "size_diff": stat.size_diff,
+            "count_diff": stat.count_diff,
+        }
+        for stat in stats[:top_allocations]
+        if stat.size_diff
+    ]
+
+
+def _redacted_query(query_string: bytes) -> str:
+    params = parse_qsl(query_string.decode("latin-1"), keep_blank_values=True)
+    return urlencode(
+        [
+            (name, "[redacted]" if name.lower() in secret_params else value)
+            for name, value in params
+        ],
+        safe="[]",
+    )
+
+
+def _prune():
+    profiles = sorted(
+        file.removesuffix(".json")
+        for file in os.listdir(profiles_folder)
+        if file.endswith(".json")
+    )
+    for profile_id in profiles[: max(0, len(profiles) - settings.profile_keep)]:
+        for suffix in (".json", ".folded"):
+            try:
+                os.remove(os.path.join(profiles_folder, profile_id + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def _save(
+    profile: dict,
+    sampler: Sampler,
+    snapshots: tuple[tracemalloc.Snapshot, tracemalloc.Snapshot] | None,
+):
+    sampler.join()
+    profile["samples"] = sampler.samples
+    profile["allocations"] = _allocations(*snapshots) if snapshots else []
+    os.makedirs(profiles_folder, exist_ok=True)
+    path = os.path.join(profiles_folder, profile["id"])
+    with open(path + ".folded", "w") as f:
+        for stack, count in sorted(sampler.stacks.items()):
+            f.write(f"{stack} {count}\n")
+    with open(path + ".json", "w") as f:
+        json.dump(profile, f)
+    _prune()
+    logger.info(
+        "Saved profile",
+        extra={
+            "profile_id": profile["id"],
+            "path": profile["path"],
+            "duration_ms": profile["duration_ms"],
+        },
+    )
+
+
+def list_profiles() -> list[dict]:
+    if not os.path.isdir(profiles_folder):
+        return []
+    profiles = []
+    for file in sorted(os.listdir(profiles_folder), reverse=True):
+        if file.endswith(".json"):
+            profile = get_profile(file.removesuffix(".json"))
+            if profile:
+                profiles.append(profile)
+    return profiles
+
+
+def get_profile(profile_id: str) -> dict | None:
+    if not valid_profile_id.match(profile_id):
+        return None
+    try:
+        with open(os.path.join(profiles_folder, f"{profile_id}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def folded_path(profile_id: str) -> str | None:
+    if not valid_profile_id.match(profile_id):
+        return None
+    path = os.path.join(profiles_folder, f"{profile_id}.folded")
+    return path if os.path.exists(path) else None
+
+
+async def _requested_by_admin(scope) -> str:
+    # "" when the request is not to be profiled, otherwise "cpu" (stacks
+    # only) or "memory" (stacks and allocations)
+    token = ""
+    mode = ""
+    for name, value in scope["headers"]:
+        if name == b"x-profile":
+            mode = value.decode("latin-1").strip().lower()
+        elif name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() != "bearer":
+                token = ""
+    if mode in ("", "0"):
+        return ""
+    if not token:
+        # Routes like /delegates take the token as a query parameter
+        match = re.search(rb"(?:^|&)token=([^&]+)", scope["query_string"])
+        token = match.group(1).decode("latin-1") if match else ""
+    if not token:
+        return ""
+    try:
+        principal = await auth.get_current_principal(token)
+    except HTTPException:
+        return ""
+    if principal.role != "admin":
+        return ""
+    return "memory" if mode == "memory" else "cpu"
+
+
+class ProfilingMiddleware:
+    # Plain ASGI middleware. A request is profiled when an admin sends
+    # X-Profile: 1 (or X-Profile: memory to trace allocations too) or it
+    # falls in PROFILE_SAMPLE_RATE, anything else only pays for a scan of
+    # its headers
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        mode = await _requested_by_admin(scope)
+        if not mode and (
+            settings.profile_sample_rate
+            and random.random() < settings.profile_sample_rate
+        ):
+            mode = "cpu"
+        if not mode:
+            await self.app(scope, receive, send)
+            return
+
+        profile = {
+            "id": f"{time.strftime('%Y%m%dT%H%M%S', time.gmtime())}-{uuid.uuid4().hex[:8]}",
+            "method": scope["method"],
+            "path": scope["path"],
+            "query": _redacted_query(scope["query_string"]),
+            "status": 500,
+            "started_at": time.time(),
+            "interval_ms": settings.profile_interval_ms,
+            "mode": mode,
+        }
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile["status"] = message["status"]
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"x-profile-id", profile["id"].encode()),
+                ]
+            await send(message)
+
+        sampler = Sampler(settings.profile_interval_ms / 1000)
+        before = None
+        if mode == "memory":
+            _start_tracing()
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+        sampler.start()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+            sampler.stopped.set()
+            snapshots = None
+            if before is not None:
+                profile["traced_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+                snapshots = (before, tracemalloc.take_snapshot())
+                _stop_tracing()
+            # Waiting for the sampler's last pass and comparing snapshots
+            # take a while on a busy worker, keep them off the event loop
+            await asyncio.to_thread(_save, profile, sampler, snapshots)
@@ -0,0 +1,151 @@
+from functools import lru_cache
+import json
+import logging
+import re
+import sqlite3
+import time
+
+import config
+import metrics
+
+settings = config.get_settings()
+
+logger = logging.getLogger("mundra.sql")
+
+slow_query_seconds = settings.slow_query_ms / 1000
+
+sql_seconds = metrics.Counter(
+    "mundra_sql_seconds_total",
+    "Time spent executing and fetching SQL statements",
+    ("statement", "route"),
+)
+sql_calls = metrics.Counter(
+    "mundra_sql_calls_total",
+    "SQL statements executed",
+    ("statement", "route"),
+)
+sql_rows = metrics.Counter(
+    "mundra_sql_rows_total",
+    "Rows returned or written by SQL statements",
+    ("statement", "route"),
+)
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_in_lists = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+@lru_cache(maxsize=1024)
+def normalize(sql: str) -> str:
+    # Statements differing only in literals or IN list length share a key
+    sql = " ".join(sql.split())
+    sql = _literals.sub("?", sql)
+    return _in_lists.sub("(...)", sql)
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    # Time is counted from execute through the last fetch, since SQLite only
+    # steps through a SELECT as its rows are fetched
+    _statement = ""
+    _route = ""
+    _elapsed = 0.0
+    _rows = 0
+
+    def _start(self, sql: str):
+        self._statement = normalize(sql)
+        self._route = metrics.current_route()
+        self._elapsed = 0.0
+        self._rows = 0
+        sql_calls.inc(self._statement, self._route)
+        context = metrics.current_request.get()
+        if context:
+            context.queries += 1
+
+    def _record(self, elapsed: float, rows: int):
+        before = self._elapsed
+        self._elapsed += elapsed
+        self._rows += rows
+        sql_seconds.inc(self._statement, self._route, amount=elapsed)
+        if rows:
+            sql_rows.inc(self._statement, self._route, amount=rows)
+        if before < slow_query_seconds <= self._elapsed:
+            logger.warning(
+                "Slow query (%.1f ms, %d rows, %s): %s",
+                self._elapsed * 1000,
+                self._rows,
+                self._route,
+                self._statement,
+            )
+
+    def execute(self, sql, parameters=()):
+        self._start(sql)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(time.perf_counter() - start, 0)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._start(sql)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._record(time.perf_counter() - start, max(self.rowcount, 0))
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._record(time.perf_counter() - start, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._record(time.perf_counter() - start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._record(time.perf_counter() - start, len(rows))
+        return rows
+
+
+class ProfiledConnection(sqlite3.Connection):
+    # The C implementation of Connection.execute makes its cursor without
+    # calling cursor(), so the shortcuts are routed through it here
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def top(limit: int = 20) -> list[dict]:
+    # Top statements by total time, summed across workers and routes
+    merged = metrics.collect()
+    statements: dict[str, dict] = {}
+    for name, field in (
+        (sql_calls.name, "calls"),
+        (sql_seconds.name, "total_ms"),
+        (sql_rows.name, "rows"),
+    ):
+        for key, value in merged.get(name, {}).items():
+            statement, route = json.loads(key)
+            entry = statements.setdefault(
+                statement,
+                {"statement": statement, "calls": 0, "total_ms": 0.0, "rows": 0, "routes": {}},
+            )
+            if field == "total_ms":
+                value *= 1000
+            entry[field] += value
+            if field == "calls":
+                entry["routes"][route] = entry["routes"].get(route, 0) + value
+    for entry in statements.values():
+        entry["mean_ms"] = entry["total_ms"] / entry["calls"] if entry["calls"] else 0.0
+    return sorted(statements.values(), key=lambda e: e["total_ms"], reverse=True)[
+        :limit
+    ]
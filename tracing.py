@@ -0,0 +1,201 @@
+import atexit
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import glob
+import itertools
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+
+import orjson
+
+import config
+import logs
+
+settings = config.get_settings()
+
+# Sampled requests are written as one JSON line each to traces/<pid>.jsonl,
+# one file per worker since RotatingFileHandler can't be shared between
+# processes. Spans come from metrics.timed, so every database, auth, mail,
+# QR and export call shows up without further instrumentation
+traces_folder = os.path.join(os.path.dirname(__file__), "traces")
+
+# Trace files of workers that are gone are removed after this long
+trace_retention_seconds = 7 * 86400
+
+logger = logging.getLogger("mundra.traces")
+
+
+class Trace:
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.start = time.perf_counter()
+        self.started_at = time.time()
+        self.spans: list[dict] = []
+        self.ids = itertools.count(1)
+
+
+_trace: ContextVar[Trace | None] = ContextVar("trace", default=None)
+_span: ContextVar[int] = ContextVar("span", default=0)
+
+
+def start_span(name: str):
+    # Returns None straight away when the request isn't sampled, which is
+    # all an untraced call pays
+    trace = _trace.get()
+    if trace is None:
+        return None
+    span = {
+        "id": next(trace.ids),
+        "parent": _span.get(),
+        "name": name,
+        "thread": threading.current_thread().name,
+        "start_ms": round((time.perf_counter() - trace.start) * 1000, 3),
+    }
+    return trace, span, _span.set(span["id"])
+
+
+def end_span(handle, duration: float, error: bool = False):
+    trace, span, token = handle
+    _span.reset(token)
+    span["duration_ms"] = round(duration * 1000, 3)
+    if error:
+        span["error"] = True
+    # list.append is atomic, spans may end on threadpool threads
+    trace.spans.append(span)
+
+
+class TraceFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return orjson.dumps(record.msg).decode()
+
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+def _remove_stale():
+    now = time.time()
+    for path in glob.glob(os.path.join(traces_folder, "*.jsonl*")):
+        try:
+            if now - os.path.getmtime(path) > trace_retention_seconds:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def setup_tracing():
+    # Its own queue and listener thread, so writing traces never blocks a
+    # request and never mixes with the stdout log stream
+    global _listener
+    if _listener is not None or not settings.trace_sample_rate:
+        return
+    os.makedirs(traces_folder, exist_ok=True)
+    _remove_stale()
+    trace_queue: queue.SimpleQueue = queue.SimpleQueue()
+    output = logging.handlers.RotatingFileHandler(
+        os.path.join(traces_folder, f"{os.getpid()}.jsonl"),
+        maxBytes=settings.trace_max_bytes,
+        backupCount=settings.trace_backups,
+    )
+    output.setFormatter(TraceFormatter())
+    _listener = logging.handlers.QueueListener(trace_queue, output)
+    _listener.start()
+    atexit.register(_listener.stop)
+    logger.handlers = [logs.ContextQueueHandler(trace_queue)]
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+def find_trace(trace_id: str) -> dict | None:
+    # Newest files first, a trace id is only looked for in lines mentioning it
+    needle = orjson.dumps({"trace_id": trace_id})[1:-1]
+    paths = sorted(
+        glob.glob(os.path.join(traces_folder, "*.jsonl*")),
+        key=os.path.getmtime,
+        reverse=True,
+    )
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    if needle in line:
+                        return orjson.loads(line)
+        except FileNotFoundError:
+            continue
+    return None
+
+
+def waterfall(trace: dict) -> list[dict]:
+    # Spans with their nesting depth and bar position as a percentage of the
+    # request, for templates/trace.html
+    total = trace["duration_ms"] or 1
+    depths = {0: -1}
+    spans = []
+    for span in trace["spans"]:
+        depth = depths.get(span["parent"], -1) + 1
+        depths[span["id"]] = depth
+        spans.append(
+            {
+                **span,
+                "depth": depth,
+                "left": round(span["start_ms"] / total * 100, 3),
+                "width": round(span["duration_ms"] / total * 100, 3),
+            }
+        )
+    return spans
+
+
+class TracingMiddleware:
+    # Plain ASGI middleware, head sampled at TRACE_SAMPLE_RATE. It has to sit
+    # inside RequestIdMiddleware, the request id is the trace id
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not settings.trace_sample_rate
+            or random.random() >= settings.trace_sample_rate
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(logs.request_id.get())
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"x-trace-id", trace.trace_id.encode("latin-1")),
+                ]
+            await send(message)
+
+        token = _trace.set(trace)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _trace.reset(token)
+            route = scope.get("route")
+            logger.info(
+                {
+                    "trace_id": trace.trace_id,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "route": route.path if route else "unmatched",
+                    "status": status,
+                    "started_at": datetime.fromtimestamp(
+                        trace.started_at, timezone.utc
+                    ).isoformat(),
+                    "duration_ms": round(
+                        (time.perf_counter() - trace.start) * 1000, 3
+                    ),
+                    "spans": sorted(trace.spans, key=lambda span: span["start_ms"]),
+                }
+            )
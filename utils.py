@@ -1,12 +1,143 @@
-import qrcode
+import base64
+import csv
+from functools import lru_cache
+import hashlib
+import hmac
+import io
+import logging
 import os
+from typing import BinaryIO, Iterator
+
+import orjson
+import qrcode
+
+import config
+import metrics
+
+settings = config.get_settings()
 
 qr_folder = os.path.join(os.path.dirname(__file__), "qrcodes")
 
+logger = logging.getLogger("mundra.qr")
+
+# Badge QR codes encode "M1.<key id>.<event>.<delegate id>.<signature>", the
+# signature being the first 12 bytes of an HMAC-SHA256 over everything before
+# it, so a badge is checked without looking the delegate up
+qr_payload_version = "M1"
+
+qr_verifications = metrics.Counter(
+    "mundra_qr_verifications_total",
+    "Badge QR payloads checked by outcome",
+    ("outcome",),
+)
+
+
+@lru_cache
+def _qr_keys() -> tuple[dict[str, bytes], str]:
+    keys = {kid: secret.encode() for kid, secret in settings.qr_signing_keys.items()}
+    if not keys:
+        keys = {
+            "0": hmac.new(
+                settings.secret_key.encode(), b"qr-signing", hashlib.sha256
+            ).digest()
+        }
+    return keys, settings.qr_active_key or list(keys)[-1]
+
+
+def _qr_signature(key: bytes, message: str) -> str:
+    digest = hmac.new(key, message.encode(), hashlib.sha256).digest()[:12]
+    return base64.urlsafe_b64encode(digest).decode()
+
+
+def qr_key_id() -> str:
+    return _qr_keys()[1]
 
-def generate_qr(id: str):
+
+def sign_qr_payload(id: str, event: str) -> str:
+    keys, kid = _qr_keys()
+    message = f"{qr_payload_version}.{kid}.{event}.{id}"
+    return f"{message}.{_qr_signature(keys[kid], message)}"
+
+
+def verify_qr_payload(payload: str) -> tuple[str, str] | None:
+    # (delegate id, event) for a genuine badge, None when it is malformed,
+    # forged or signed with a key that was removed
+    message, _, signature = payload.rpartition(".")
+    parts = message.split(".", 3)
+    if len(parts) != 4 or parts[0] != qr_payload_version:
+        qr_verifications.inc("malformed")
+        return None
+    _, kid, event, id = parts
+    key = _qr_keys()[0].get(kid)
+    if key is None:
+        qr_verifications.inc("unknown_key")
+        return None
+    if not hmac.compare_digest(signature, _qr_signature(key, message)):
+        qr_verifications.inc("invalid")
+        return None
+    qr_verifications.inc("valid")
+    return id, event
+
+
+@metrics.timed("qr")
+def generate_qr(id: str, event: str, path: str):
     qr = qrcode.QRCode(version=2, box_size=7, border=1)
-    qr.add_data(id)
+    qr.add_data(sign_qr_payload(id, event))
     qr.make(fit=True)
     img = qr.make_image(fill_color="black", back_color="white")
-    img.save(f"{qr_folder}/{id}.jpg")
+    img.save(path)
+    logger.info("Generated QR code", extra={"delegate_id": id, "event": event})
+
+
+def qr_path(id: str, event: str) -> str:
+    # QR images only depend on the id, event and signing key, so a generated
+    # one is reused until the active key changes
+    os.makedirs(qr_folder, exist_ok=True)
+    path = f"{qr_folder}/{event}-{qr_key_id()}-{id}.jpg"
+    if not os.path.exists(path):
+        generate_qr(id, event, path)
+    return path
+
+
+def qr_data_uri(id: str, event: str) -> str:
+    with open(qr_path(id, event), "rb") as f:
+        return "data:image/jpeg;base64," + base64.b64encode(f.read()).decode()
+
+
+def parse_csv_pastmuns(value: str) -> list[dict]:
+    # Inverse of the "name | committee | delegation | year | award ; ..." export format
+    pastmuns = []
+    for mun in value.split(";"):
+        fields = [field.strip() for field in mun.split("|")]
+        if fields == [""]:
+            continue
+        pastmuns.append(dict(zip(["name", "committee", "delegation", "year", "award"], fields)))
+    return pastmuns
+
+
+def iter_import_rows(
+    file: BinaryIO, format: str
+) -> Iterator[tuple[int, dict | None, str]]:
+    # Yields (row number, record, error) without loading the whole upload in memory
+    if format == "csv":
+        reader = csv.DictReader(io.TextIOWrapper(file, encoding="utf-8-sig", newline=""))
+        for row, record in enumerate(reader, start=2):
+            record = {k: v for k, v in record.items() if k and v not in ("", None)}
+            if "pastmuns" in record:
+                record["pastmuns"] = parse_csv_pastmuns(record["pastmuns"])
+            yield row, record, ""
+    elif format == "ndjson":
+        for row, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                yield row, None, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(record, dict):
+                yield row, None, "Expected a JSON object"
+                continue
+            yield row, record, ""
+    else:
+        raise ValueError(f"Unsupported import format: {format}")